@@ -0,0 +1,678 @@
+"""Offline load test for the rename pipeline.
+
+Drives the real handlers in bot.py (handle_file, start_rename_callback,
+handle_filename and upload_type_callback) for N concurrent users, plus users
+sending media groups of large files through the batch template dialog,
+against a fake Telegram client that simulates DC bandwidth, latency, FloodWait and
+chunked media, with an in-memory stand-in for the Motor collections. Nothing
+leaves the machine.
+
+    python benchmark.py --users 20
+    python benchmark.py --users 20 --save-baseline
+
+Each run is compared against benchmark_baseline.json when it holds a
+baseline for the same scenario, and exits with status 1 when a metric got
+worse by more than --tolerance. Bot settings come from the environment as
+usual, e.g. PROGRESS_INTERVAL=2 python benchmark.py.
+"""
+import os
+import io
+import sys
+import copy
+import json
+import time
+import random
+import re
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import mimetypes
+from types import SimpleNamespace
+from pyrogram import raw
+from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait, FilePartMissing
+from pyrogram.file_id import FileId, FileType, FileUniqueId, FileUniqueType
+from pyrogram.parser import Parser
+from pyrogram.session.internals import MsgId
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(ROOT, "benchmark_baseline.json")
+MB = 1024 * 1024
+BOT_ID = 777000
+
+# (weight, smallest MB, largest MB, message kind, extension)
+FILE_MIX = (
+    (0.35, 0.2, 8, "document", "pdf"),
+    (0.25, 1, 15, "document", "zip"),
+    (0.25, 20, 150, "video", "mp4"),
+    (0.15, 300, 900, "video", "mkv"),
+)
+
+# Metric -> (direction, absolute slack) used by the regression check
+METRICS = {
+    "jobs_per_s": ("higher", 0.0),
+    "latency_p50": ("lower", 0.05),
+    "latency_p95": ("lower", 0.05),
+    "latency_p99": ("lower", 0.05),
+    "edits_per_job": ("lower", 0.5),
+    "peak_rss_mb": ("lower", 16),
+    "peak_disk_mb": ("lower", 16),
+    "batch_files_renamed": ("higher", 0),
+}
+
+# bot.py is imported inside main(), after the environment and working directory are set up
+bot = None
+
+
+# ========== FAKE MONGO ==========
+class FakeCollection:
+    """The part of a Motor collection bot.py uses, kept in a dict"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.docs = {}
+        self.calls = 0
+
+    async def _roundtrip(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    def _ids(self, query):
+        if not query:
+            return list(self.docs)
+        wanted = query["_id"]
+        if isinstance(wanted, dict):
+            return [_id for _id in wanted["$in"] if _id in self.docs]
+        return [wanted] if wanted in self.docs else []
+
+    @staticmethod
+    def _project(doc, projection):
+        if doc is None or not projection:
+            return copy.deepcopy(doc)
+        return {key: copy.deepcopy(value) for key, value in doc.items() if key == "_id" or projection.get(key)}
+
+    def _update(self, query, update, upsert):
+        """Apply $set/$inc to the matching document, returns it as it was before"""
+        _id = query["_id"]
+        before = self.docs.get(_id)
+        if before is None and not upsert:
+            return None
+        doc = copy.deepcopy(before) if before else {"_id": _id}
+        doc.update(copy.deepcopy(update.get("$set", {})))
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + amount
+        self.docs[_id] = doc
+        return before
+
+    async def create_index(self, keys, **kwargs):
+        await self._roundtrip()
+        return f"{keys}_1"
+
+    async def find_one(self, query, projection=None):
+        await self._roundtrip()
+        ids = self._ids(query)
+        return self._project(self.docs[ids[0]], projection) if ids else None
+
+    async def find(self, query=None):
+        await self._roundtrip()
+        for _id in self._ids(query):
+            yield copy.deepcopy(self.docs[_id])
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False):
+        await self._roundtrip()
+        return self._project(self._update(query, update, upsert), projection)
+
+    async def update_one(self, query, update, upsert=False):
+        await self._roundtrip()
+        self._update(query, update, upsert)
+
+    async def replace_one(self, query, doc, upsert=False):
+        await self._roundtrip()
+        if upsert or query["_id"] in self.docs:
+            self.docs[query["_id"]] = copy.deepcopy(doc)
+
+    async def delete_one(self, query):
+        await self._roundtrip()
+        for _id in self._ids(query)[:1]:
+            del self.docs[_id]
+
+    async def delete_many(self, query):
+        await self._roundtrip()
+        for _id in self._ids(query):
+            del self.docs[_id]
+
+    async def bulk_write(self, requests, ordered=True):
+        await self._roundtrip()
+        for request in requests:
+            self._update(request._filter, request._doc, request._upsert)
+
+
+# ========== FAKE TELEGRAM ==========
+class Link:
+    """One direction of a DC's bandwidth, shared by every request on it"""
+
+    def __init__(self, rate, latency):
+        self.rate = rate
+        self.latency = latency
+        self.busy_until = 0
+
+    async def transfer(self, size):
+        now = time.monotonic()
+        self.busy_until = max(now, self.busy_until) + size / self.rate
+        await asyncio.sleep(self.busy_until - now + self.latency * random.uniform(0.5, 1.5))
+
+
+class FakeTelegram:
+    """Server side state: media, uploaded parts, chats and what the bot sent them"""
+
+    def __init__(self, args):
+        self.download = Link(args.bandwidth * MB, args.latency / 1000)
+        self.upload = Link(args.bandwidth * MB, args.latency / 1000)
+        self.api_latency = args.latency / 1000
+        self.flood_rate = args.flood_rate
+        self.block = random.randbytes(MB)
+        self.media = {}  # media_id -> size
+        self.uploads = {}  # upload file_id -> parts received
+        self.messages = {}  # (chat_id, message_id) -> FakeMessage
+        self.next_id = 1
+        self.waiting = {}  # chat_id -> future resolved by the job's final message
+        self.counters = {"edits": 0, "flood_waits": 0, "messages": 0, "deletes": 0, "api_calls": 0}
+        self.batch_files = {"sent": 0, "renamed": 0}
+        self.unsupported_calls = []
+
+    def unsupported(self, where, query):
+        """Fail a call the fakes do not implement, and remember it so the run fails too"""
+        name = type(query).__name__
+        self.unsupported_calls.append(f"{where}.{name}")
+        raise AssertionError(f"{where} does not support {name}; extend the benchmark fakes")
+
+    def message_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    async def api(self, chat_id, kind):
+        """One chat API round trip, edits occasionally answered with a FloodWait"""
+        self.counters["api_calls"] += 1
+        await asyncio.sleep(self.api_latency * random.uniform(0.5, 1.5))
+        if kind == "edit":
+            if random.random() < self.flood_rate:
+                self.counters["flood_waits"] += 1
+                raise FloodWait(value=random.randint(1, 3))
+            self.counters["edits"] += 1
+
+    def deliver(self, chat_id, text):
+        """Resolve a user's wait when the bot sends its final word on a job"""
+        waiter = self.waiting.get(chat_id)
+        if waiter is None or waiter.done():
+            return
+        if text.startswith("**✅ Batch Finished"):
+            # A batch finishes even when some files failed, so count what it renamed
+            renamed, total = map(int, re.search(r"`(\d+)` of `(\d+)`", text).groups())
+            self.batch_files["renamed"] += renamed
+            waiter.set_result(renamed == total)
+        elif text.startswith("**✅ File Renamed"):
+            waiter.set_result(True)
+        elif text.startswith(("**❌", "**🚦")):
+            waiter.set_result(False)
+
+
+class FakeMediaSession:
+    """A media DC connection answering GetFile and SaveFilePart"""
+
+    def __init__(self, telegram):
+        self.telegram = telegram
+
+    async def invoke(self, query, sleep_threshold=None):
+        telegram = self.telegram
+        if isinstance(query, raw.functions.upload.GetFile):
+            size = max(0, min(query.limit, telegram.media[query.location.id] - query.offset))
+            await telegram.download.transfer(size)
+            return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0, bytes=telegram.block[:size])
+        if isinstance(query, (raw.functions.upload.SaveFilePart, raw.functions.upload.SaveBigFilePart)):
+            await telegram.upload.transfer(len(query.bytes))
+            telegram.uploads.setdefault(query.file_id, set()).add(query.file_part)
+            return True
+        telegram.unsupported("FakeMediaSession", query)
+
+
+class FakeSessionPool:
+    """Replaces bot.media_sessions with connections to the fake DCs"""
+
+    def __init__(self, telegram):
+        self.telegram = telegram
+
+    async def get(self, client, dc_id, count):
+        return [FakeMediaSession(self.telegram) for _ in range(count)]
+
+    async def home(self, client, count):
+        return await self.get(client, 2, count)
+
+    async def close(self):
+        pass
+
+
+class FakeMessage:
+    """Just enough of pyrogram's Message for the handlers and jobs"""
+
+    def __init__(self, client, chat_id, from_id, text="", media_kind=None, media=None):
+        self._client = client
+        self.id = client.telegram.message_id()
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=from_id)
+        self.text = text
+        self.empty = False
+        self.media_group_id = None
+        self.media = SimpleNamespace(value=media_kind) if media_kind else None
+        self.document = self.video = self.audio = None
+        if media_kind:
+            setattr(self, media_kind, media)
+        client.telegram.messages[(chat_id, self.id)] = self
+
+    async def reply_text(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text)
+
+    async def reply_document(self, document, caption="", **kwargs):
+        return await self._client.send_message(self.chat.id, caption)
+
+    async def edit(self, text, **kwargs):
+        await self._client.edit_message_text(self.chat.id, self.id, text)
+        self.text = text
+        return self
+
+    edit_text = edit
+
+    async def delete(self):
+        await self._client.delete_messages(self.chat.id, self.id)
+
+
+class FakeCallbackQuery:
+    def __init__(self, client, user_id, data, message):
+        self._client = client
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = message
+
+    async def answer(self, text=None, show_alert=False):
+        await self._client.telegram.api(self.from_user.id, "answer")
+
+
+class FakeClient:
+    """Stands in for the bot's Client; chat calls are shaped by bot.outbound like BotClient.invoke"""
+
+    parse_mode = ParseMode.DEFAULT
+    is_connected = True
+
+    def __init__(self, telegram):
+        self.telegram = telegram
+        self.parser = Parser(self)
+        self.rnd_id = MsgId
+        self.message_cache = {}  # filled by Message._parse
+
+    def guess_mime_type(self, filename):
+        return mimetypes.guess_type(filename)[0]
+
+    async def _chat(self, raw_type, chat_id, kind):
+        priority = bot.OUTBOUND_PRIORITIES[raw_type]
+        await bot.outbound.call(
+            chat_id, priority, self.telegram.api, chat_id, kind,
+            retry_flood=priority != bot.PRIORITY_PROGRESS
+        )
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._chat(raw.functions.messages.SendMessage, chat_id, "send")
+        self.telegram.counters["messages"] += 1
+        message = FakeMessage(self, chat_id, BOT_ID, text)
+        self.telegram.deliver(chat_id, text)
+        return message
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._chat(raw.functions.messages.EditMessage, chat_id, "edit")
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self._chat(raw.functions.messages.DeleteMessages, chat_id, "delete")
+        self.telegram.counters["deletes"] += 1
+
+    async def send_cached_media(self, chat_id, file_id, caption="", **kwargs):
+        await self._chat(raw.functions.messages.SendMedia, chat_id, "send")
+        return FakeMessage(self, chat_id, BOT_ID, caption)
+
+    async def get_messages(self, chat_id, message_id):
+        await self.telegram.api(chat_id, "get")
+        return self.telegram.messages.get((chat_id, message_id))
+
+    async def resolve_peer(self, chat_id):
+        return raw.types.InputPeerUser(user_id=chat_id, access_hash=0)
+
+    async def save_file(self, path):
+        if path is None:
+            return None
+        size = os.path.getsize(path)
+        await self.telegram.upload.transfer(size)
+        return raw.types.InputFile(id=self.rnd_id(), parts=1, name=os.path.basename(path), md5_checksum="")
+
+    async def stream_media(self, message, limit=0, offset=0):
+        size = self.telegram.media[FileId.decode(bot.message_media(message).file_id).media_id]
+        chunks = -(-size // MB)
+        end = min(chunks, offset + limit) if limit else chunks
+        for chunk in range(offset, end):
+            length = min(MB, size - chunk * MB)
+            await self.telegram.download.transfer(length)
+            yield self.telegram.block[:length]
+
+    async def download_media(self, message, in_memory=False, file_name=None, progress=None, progress_args=()):
+        if isinstance(message, str):
+            # A user's thumbnail
+            await self.telegram.download.transfer(len(THUMBNAIL))
+            return io.BytesIO(THUMBNAIL)
+        buffer = io.BytesIO()
+        async for chunk in self.stream_media(message):
+            buffer.write(chunk)
+            if progress:
+                await progress(buffer.tell(), buffer.tell(), *progress_args)
+        if in_memory:
+            return buffer
+        with open(file_name, "wb") as f:
+            f.write(buffer.getvalue())
+        return file_name
+
+    async def invoke(self, query, **kwargs):
+        if not isinstance(query, raw.functions.messages.SendMedia):
+            self.telegram.unsupported("FakeClient", query)
+        chat_id = query.peer.user_id
+        await self._chat(raw.functions.messages.SendMedia, chat_id, "send")
+
+        input_file = query.media.file
+        received = self.telegram.uploads.pop(input_file.id, set())
+        missing = set(range(input_file.parts)) - received
+        if missing:
+            raise FilePartMissing(value=min(missing))
+
+        document = raw.types.Document(
+            id=random.getrandbits(62), access_hash=0, file_reference=b"", date=int(time.time()),
+            mime_type=query.media.mime_type, size=0, dc_id=2, attributes=query.media.attributes, thumbs=[]
+        )
+        message = raw.types.Message(
+            id=self.telegram.message_id(),
+            peer_id=raw.types.PeerUser(user_id=chat_id),
+            from_id=raw.types.PeerUser(user_id=BOT_ID),
+            date=int(time.time()),
+            message=query.message,
+            entities=query.entities or [],
+            media=raw.types.MessageMediaDocument(document=document),
+            out=True
+        )
+        return raw.types.Updates(
+            updates=[raw.types.UpdateNewMessage(message=message, pts=0, pts_count=0)],
+            users=[raw.types.User(id=chat_id, first_name="User", restriction_reason=[]), raw.types.User(id=BOT_ID, first_name="Bot", bot=True, restriction_reason=[])],
+            chats=[], date=int(time.time()), seq=0
+        )
+
+
+# ========== LOAD ==========
+def make_thumbnail():
+    """A JPEG the thumbnail pipeline accepts, or opaque bytes when Pillow is missing"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return random.randbytes(30 * 1024)
+    out = io.BytesIO()
+    Image.new("RGB", (640, 360), (40, 90, 160)).save(out, "JPEG")
+    return out.getvalue()
+
+THUMBNAIL = b""
+
+def pick_file(rng):
+    roll = rng.random()
+    for weight, low, high, kind, extension in FILE_MIX:
+        roll -= weight
+        if roll <= 0:
+            break
+    return kind, extension, int(rng.uniform(low, high) * MB)
+
+def pick_batch_file(rng):
+    """Batch files are big enough to be streamed, never kept in memory"""
+    low = bot.Config.IN_MEMORY_MAX_MB + 5
+    return "video", "mp4", int(rng.uniform(low, low + 50) * MB)
+
+def incoming_file(client, user_id, n, rng, pick=pick_file):
+    """A user's message carrying a new file with an encoded, fetchable file_id"""
+    kind, extension, size = pick(rng)
+    media_id = rng.getrandbits(62)
+    client.telegram.media[media_id] = size
+    file_type = FileType.VIDEO if kind == "video" else FileType.DOCUMENT
+    media = SimpleNamespace(
+        file_id=FileId(file_type=file_type, dc_id=2, media_id=media_id, access_hash=0, file_reference=b"").encode(),
+        file_unique_id=FileUniqueId(file_unique_type=FileUniqueType.DOCUMENT, media_id=media_id).encode(),
+        file_name=f"upload_{user_id}_{n}.{extension}",
+        file_size=size,
+        duration=rng.randint(60, 3600) if kind == "video" else 0
+    )
+    return FakeMessage(client, user_id, user_id, media_kind=kind, media=media), kind
+
+async def run_user(client, user_id, jobs, rng, think):
+    """One user going through the rename dialog `jobs` times, returns [(latency, ok)]"""
+    telegram = client.telegram
+    results = []
+    for n in range(jobs):
+        started = time.monotonic()
+        done = telegram.waiting[user_id] = asyncio.get_running_loop().create_future()
+        message, kind = incoming_file(client, user_id, n, rng)
+
+        await bot.handle_file(client, message)
+        session = await bot.sessions.get(user_id)
+        if not session:
+            results.append((time.monotonic() - started, False))
+            continue
+        prompt = telegram.messages[(user_id, session.prompt_message_id)]
+
+        await asyncio.sleep(rng.uniform(0, think))
+        await bot.start_rename_callback(client, FakeCallbackQuery(client, user_id, "start_rename", prompt))
+
+        await asyncio.sleep(rng.uniform(0, think))
+        await bot.handle_filename(client, FakeMessage(client, user_id, user_id, text=f"renamed_{user_id}_{n}"))
+
+        session = await bot.sessions.get(user_id)
+        if session and session.step == "awaiting_upload_type":
+            await asyncio.sleep(rng.uniform(0, think))
+            upload_type = "video" if kind == "video" else "document"
+            await bot.upload_type_callback(client, FakeCallbackQuery(client, user_id, f"upload_{upload_type}", prompt))
+
+        ok = await done
+        results.append((time.monotonic() - started, ok))
+    return results
+
+async def run_batch_user(client, user_id, batches, files, rng, think):
+    """One user sending `batches` media groups of `files` large files, returns [(latency, ok)]"""
+    telegram = client.telegram
+    results = []
+    for n in range(batches):
+        started = time.monotonic()
+        done = telegram.waiting[user_id] = asyncio.get_running_loop().create_future()
+        group_id = f"{user_id}-{n}"
+        for i in range(files):
+            message, _ = incoming_file(client, user_id, n * files + i, rng, pick_batch_file)
+            message.media_group_id = group_id
+            await bot.handle_file(client, message)
+        telegram.batch_files["sent"] += files
+        session = await bot.sessions.get(user_id)
+        if not session or len(session.files()) != files:
+            results.append((time.monotonic() - started, False))
+            continue
+        prompt = telegram.messages[(user_id, session.prompt_message_id)]
+
+        await asyncio.sleep(rng.uniform(0, think))
+        await bot.start_rename_callback(client, FakeCallbackQuery(client, user_id, "start_rename", prompt))
+
+        await asyncio.sleep(rng.uniform(0, think))
+        await bot.handle_filename(client, FakeMessage(client, user_id, user_id, text=f"batch_{user_id}_{n} {{n:02}}"))
+
+        session = await bot.sessions.get(user_id)
+        if session and session.step == "awaiting_upload_type":
+            await asyncio.sleep(rng.uniform(0, think))
+            await bot.upload_type_callback(client, FakeCallbackQuery(client, user_id, "upload_video", prompt))
+
+        ok = await done
+        results.append((time.monotonic() - started, ok))
+    return results
+
+async def watch_disk(path, peak):
+    while True:
+        peak[0] = max(peak[0], bot.disk_usage(path))
+        await asyncio.sleep(0.1)
+
+async def run(args, workdir):
+    telegram = FakeTelegram(args)
+    client = FakeClient(telegram)
+    bot.media_sessions = FakeSessionPool(telegram)
+    users = FakeCollection(args.db_latency / 1000)
+    bot.db.col = users
+    bot.result_cache.col = FakeCollection(args.db_latency / 1000)
+    bot.sessions.col = FakeCollection(args.db_latency / 1000)
+
+    rng = random.Random(args.seed)
+    user_ids = [100000 + i for i in range(args.users)]
+    batch_user_ids = [200000 + i for i in range(args.batch_users)]
+    for user_id in user_ids:
+        if rng.random() < args.thumb_ratio:
+            users.docs[user_id] = {"_id": user_id, "file_id": f"thumb-{user_id}"}
+
+    peak_disk = [0]
+    watcher = asyncio.create_task(watch_disk(workdir, peak_disk))
+    started = time.monotonic()
+    try:
+        per_user = await asyncio.gather(
+            *(
+                run_user(client, user_id, args.jobs, random.Random(rng.random()), args.think)
+                for user_id in user_ids
+            ),
+            *(
+                run_batch_user(client, user_id, args.jobs, args.batch_files, random.Random(rng.random()), args.think)
+                for user_id in batch_user_ids
+            )
+        )
+    finally:
+        watcher.cancel()
+    elapsed = time.monotonic() - started
+    if telegram.unsupported_calls:
+        raise AssertionError(f"The benchmark fakes were asked for unsupported calls: {sorted(set(telegram.unsupported_calls))}")
+
+    results = [result for user_results in per_user for result in user_results]
+    latencies = [latency for latency, ok in results if ok]
+    completed = len(latencies)
+    return {
+        "jobs": len(results),
+        "completed": completed,
+        "failed": len(results) - completed,
+        "seconds": round(elapsed, 2),
+        "jobs_per_s": round(completed / elapsed, 3),
+        "latency_p50": round(bot.percentile(latencies, 50), 3),
+        "latency_p95": round(bot.percentile(latencies, 95), 3),
+        "latency_p99": round(bot.percentile(latencies, 99), 3),
+        "edits_per_job": round(telegram.counters["edits"] / max(len(results), 1), 2),
+        "flood_waits": telegram.counters["flood_waits"],
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_disk_mb": round(peak_disk[0] / MB, 1),
+        "mongo_calls": users.calls + bot.result_cache.col.calls + bot.sessions.col.calls,
+        "batch_files": telegram.batch_files["sent"],
+        "batch_files_renamed": telegram.batch_files["renamed"],
+    }
+
+
+# ========== BASELINE ==========
+def regressions(metrics, baseline, tolerance):
+    found = []
+    for name, (direction, slack) in METRICS.items():
+        base, value = baseline.get(name), metrics.get(name)
+        if base is None or value is None:
+            continue
+        if direction == "higher" and value < base * (1 - tolerance) - slack:
+            found.append(f"{name} fell from {base} to {value}")
+        elif direction == "lower" and value > base * (1 + tolerance) + slack:
+            found.append(f"{name} rose from {base} to {value}")
+    return found
+
+BENCHMARK_ENV = ("API_ID", "API_HASH", "BOT_TOKEN", "DB_URL", "TRACE_SPANS")
+
+def scenario(args):
+    """What a baseline is only comparable with: the load and any bot settings overridden"""
+    load = {
+        key: getattr(args, key)
+        for key in ("users", "batch_users", "batch_files", "jobs", "seed", "bandwidth", "latency", "db_latency", "flood_rate", "thumb_ratio", "think")
+    }
+    load["settings"] = {
+        key: os.environ[key] for key in sorted(os.environ)
+        if hasattr(bot.Config, key) and key not in BENCHMARK_ENV
+    }
+    return load
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the rename bot")
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--batch-users", type=int, default=4, help="concurrent users renaming media groups")
+    parser.add_argument("--batch-files", type=int, default=3, help="large files in each media group")
+    parser.add_argument("--jobs", type=int, default=1, help="files (or media groups) each user renames, one after another")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bandwidth", type=float, default=200, help="MB/s per direction to the DC")
+    parser.add_argument("--latency", type=float, default=40, help="ms per Telegram request")
+    parser.add_argument("--db-latency", type=float, default=2, help="ms per Mongo round trip")
+    parser.add_argument("--flood-rate", type=float, default=0.05, help="share of edits answered with FloodWait")
+    parser.add_argument("--thumb-ratio", type=float, default=0.3, help="share of users with a custom thumbnail")
+    parser.add_argument("--think", type=float, default=0.5, help="longest pause between dialog steps, seconds")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's warnings")
+    args = parser.parse_args()
+
+    global bot, THUMBNAIL
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.ERROR)
+    for key, value in zip(BENCHMARK_ENV, ("1", "benchmark", "1:benchmark", "mongodb://benchmark.invalid", "false")):
+        os.environ.setdefault(key, value)
+
+    random.seed(args.seed)
+    THUMBNAIL = make_thumbnail()
+    workdir = tempfile.mkdtemp(prefix="rebot-benchmark-")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    try:
+        import bot as bot_module
+        bot = bot_module
+        metrics = asyncio.run(run(args, workdir))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(metrics, indent=2))
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)
+
+    if args.save_baseline:
+        baselines = {"scenario": scenario(args), "metrics": metrics}
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Baseline saved to {BASELINE_FILE}")
+        return 0
+
+    if metrics["failed"]:
+        print(f"{metrics['failed']} jobs failed")
+        return 1
+    if not baselines:
+        print("No baseline yet, run with --save-baseline to store one")
+        return 0
+    if baselines["scenario"] != scenario(args):
+        print("Baseline was recorded for a different scenario, not comparing")
+        return 0
+
+    found = regressions(metrics, baselines["metrics"], args.tolerance)
+    for regression in found:
+        print(f"REGRESSION: {regression}")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
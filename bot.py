@@ -1,15 +1,43 @@
+import time
+BOOT_TIME = time.monotonic()  # startup is timed from the first import
+
 import os
+import io
 import asyncio
+import contextvars
+import importlib.util
+import json
 import logging
 import math
-import time
+import multiprocessing
+import random
 import re
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import shutil
+import socket
+import string
+import struct
+import sys
 import threading
-from pyrogram import Client, filters
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from hashlib import md5, sha256
+from pyrogram import Client, filters, idle, raw, types, utils
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from pyrogram.errors import QueryIdInvalid, MessageNotModified
+from pyrogram.errors import (
+    QueryIdInvalid, MessageNotModified, FloodWait, FileIdInvalid, FileReferenceExpired,
+    FileReferenceInvalid, MediaEmpty, AuthBytesInvalid, FilePartMissing, InternalServerError
+)
+from pyrogram.file_id import FileId
+from pyrogram.session import Session, Auth
 import motor.motor_asyncio
+from pymongo import ReturnDocument, UpdateOne
+
+# Pillow is only imported by the thumbnail workers, when the first thumbnail arrives
+PILLOW = importlib.util.find_spec("PIL") is not None
 
 # ========== CONFIG ==========
 class Config:
@@ -18,65 +46,334 @@ class Config:
     BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
     DB_URL = os.environ.get("DB_URL", "")
     DB_NAME = "RenameBot"
+    PORT = int(os.environ.get("PORT", 8080))
+    # "all" runs everything in one process; "frontend" only talks to users and queues
+    # jobs in Mongo, "worker" only claims and runs them (one or more per host)
+    BOT_ROLE = os.environ.get("BOT_ROLE", "all").lower()
+    WORKER_ID = os.environ.get("WORKER_ID", socket.gethostname())
+    JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 60))
+    JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", 2))
+    JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+    # Seconds running jobs get to finish on SIGTERM before they are checkpointed
+    DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 20))
+    # Connections opened before the bot reports ready, so the first job doesn't wait for them.
+    # Media sessions go to the bot's own DC plus any DCs listed in WARM_DCS, e.g. "1,4"
+    WARM_MONGO_CONNECTIONS = int(os.environ.get("WARM_MONGO_CONNECTIONS", 4))
+    WARM_DCS = {int(x) for x in re.split(r"[\s,]+", os.environ.get("WARM_DCS", "")) if x}
+    # Telegram user ids allowed to use admin commands such as /profile
+    ADMINS = {int(x) for x in re.split(r"[\s,]+", os.environ.get("ADMINS", "")) if x}
+    # JSON timing spans for every job stage, and the event loop stall threshold for /profile
+    TRACE_SPANS = os.environ.get("TRACE_SPANS", "true").lower() == "true"
+    STALL_THRESHOLD_MS = int(os.environ.get("STALL_THRESHOLD_MS", 100))
+    # Pipe download chunks straight into upload parts instead of going through disk
+    STREAM_MODE = os.environ.get("STREAM_MODE", "true").lower() == "true"
+    STREAM_BUFFER_PARTS = int(os.environ.get("STREAM_BUFFER_PARTS", 8))
+    # Minimum seconds between two edits of a progress message
+    PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 5))
+    # Parallel ranged downloads for large files
+    DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", 4))
+    DOWNLOAD_CHUNK_KB = int(os.environ.get("DOWNLOAD_CHUNK_KB", 1024))
+    PARALLEL_DOWNLOAD_MIN_MB = int(os.environ.get("PARALLEL_DOWNLOAD_MIN_MB", 20))
+    # Parallel part uploads: connections, and the starting/maximum parts in flight
+    UPLOAD_CONNECTIONS = int(os.environ.get("UPLOAD_CONNECTIONS", 4))
+    UPLOAD_START_INFLIGHT = int(os.environ.get("UPLOAD_START_INFLIGHT", 4))
+    UPLOAD_MAX_INFLIGHT = int(os.environ.get("UPLOAD_MAX_INFLIGHT", 16))
+    # Retries of a failed transfer, resumed from its last checkpoint
+    TRANSFER_RETRIES = int(os.environ.get("TRANSFER_RETRIES", 3))
+    RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 2))
+    CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", 1))
+    CHECKPOINT_MAX_AGE_HOURS = float(os.environ.get("CHECKPOINT_MAX_AGE_HOURS", 6))
+    # Files up to IN_MEMORY_MAX_MB never touch the disk while the total stays under IN_MEMORY_TOTAL_MB
+    IN_MEMORY_MAX_MB = float(os.environ.get("IN_MEMORY_MAX_MB", 10))
+    IN_MEMORY_TOTAL_MB = float(os.environ.get("IN_MEMORY_TOTAL_MB", 100))
+    # Temporary storage for transfers that go through disk
+    STORAGE_QUOTA_MB = int(os.environ.get("STORAGE_QUOTA_MB", 8192))
+    STORAGE_MIN_FREE_MB = int(os.environ.get("STORAGE_MIN_FREE_MB", 256))
+    STORAGE_WAIT_SECONDS = float(os.environ.get("STORAGE_WAIT_SECONDS", 300))
+    STORAGE_SWEEP_MINUTES = float(os.environ.get("STORAGE_SWEEP_MINUTES", 30))
+    # Optional tmpfs (e.g. /dev/shm) for the data of small disk-path jobs
+    TMPFS_DIR = os.environ.get("TMPFS_DIR", "")
+    TMPFS_MAX_MB = int(os.environ.get("TMPFS_MAX_MB", 50))
+    TMPFS_QUOTA_MB = int(os.environ.get("TMPFS_QUOTA_MB", 256))
+    # Read duration/width/height from the first and last chunks of media files
+    PROBE_MEDIA = os.environ.get("PROBE_MEDIA", "true").lower() == "true"
+    PROBE_TAIL_CHUNKS = int(os.environ.get("PROBE_TAIL_CHUNKS", 2))
+    PROBE_CACHE_SIZE = int(os.environ.get("PROBE_CACHE_SIZE", 2000))
+    # Batch renames: files sent within BATCH_WINDOW seconds (or one media group) form a batch
+    BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW", 30))
+    BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 100))
+    BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", 3))
+    # Outbound API shaping (calls per second and burst size)
+    OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 25))
+    OUTBOUND_GLOBAL_BURST = int(os.environ.get("OUTBOUND_GLOBAL_BURST", 30))
+    OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", 1))
+    OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", 3))
+    # Job scheduler limits
+    MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 4))
+    MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", 1))
+    MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 100))
+    MAX_QUEUED_PER_USER = int(os.environ.get("MAX_QUEUED_PER_USER", 5))
+    # Size lanes: upper bound in MB, concurrent slots, and slots held back for the lane
+    LANE_SMALL_MAX_MB = int(os.environ.get("LANE_SMALL_MAX_MB", 20))
+    LANE_SMALL_SLOTS = int(os.environ.get("LANE_SMALL_SLOTS", 2))
+    LANE_SMALL_RESERVED = int(os.environ.get("LANE_SMALL_RESERVED", 1))
+    LANE_MEDIUM_MAX_MB = int(os.environ.get("LANE_MEDIUM_MAX_MB", 500))
+    LANE_MEDIUM_SLOTS = int(os.environ.get("LANE_MEDIUM_SLOTS", 2))
+    LANE_MEDIUM_RESERVED = int(os.environ.get("LANE_MEDIUM_RESERVED", 1))
+    LANE_LARGE_SLOTS = int(os.environ.get("LANE_LARGE_SLOTS", 2))
+    LANE_LARGE_RESERVED = int(os.environ.get("LANE_LARGE_RESERVED", 0))
+    # Days an unused rename result stays re-sendable by file_id
+    RESULT_CACHE_TTL_DAYS = int(os.environ.get("RESULT_CACHE_TTL_DAYS", 30))
+    # Local copies of user thumbnails
+    THUMB_CACHE_DIR = os.environ.get("THUMB_CACHE_DIR", "thumbs")
+    THUMB_CACHE_MAX_MB = int(os.environ.get("THUMB_CACHE_MAX_MB", 50))
+    THUMB_WORKERS = int(os.environ.get("THUMB_WORKERS", 1))
+    # In-process user profile cache and write batching
+    PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 10000))
+    PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", 300))
+    PROFILE_WRITE_BATCH = int(os.environ.get("PROFILE_WRITE_BATCH", 100))
+    PROFILE_WRITE_WINDOW = float(os.environ.get("PROFILE_WRITE_WINDOW", 0.05))
+    # Invalidate other processes' profile caches through a Mongo change stream (needs a replica set)
+    PROFILE_CHANGE_STREAM = os.environ.get("PROFILE_CHANGE_STREAM", "false").lower() == "true"
+    # Rename dialog sessions
+    SESSION_TTL = int(os.environ.get("SESSION_TTL", 1800))
+    SESSION_MAX = int(os.environ.get("SESSION_MAX", 10000))
+    SESSION_PERSIST = os.environ.get("SESSION_PERSIST", "true").lower() == "true"
 
-# ========== SIMPLE HTTP SERVER FOR RENDER PORT ==========
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Bot is running!')
-    
-    def log_message(self, format, *args):
-        pass
+# ========== METRICS ==========
+class Histogram:
+    """Prometheus-style latency histogram with one series per label value"""
+
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # label value -> [per-bucket counts, sum, count]
 
-def run_health_server():
-    server = HTTPServer(('0.0.0.0', 8080), HealthHandler)
-    print("🌐 Health check server running on port 8080")
-    server.serve_forever()
+    def observe(self, label_value, value):
+        series = self.series.setdefault(label_value, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
 
-# Start health server in background
-health_thread = threading.Thread(target=run_health_server, daemon=True)
-health_thread.start()
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {count}')
+        return lines
+
+stage_latency = Histogram(
+    "rebot_stage_seconds", "Time spent in each stage of a job", "stage",
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+
+# Spans are written as one JSON object per line, tagged with the job they belong to
+trace_log = logging.getLogger("rebot.trace")
+trace_log.setLevel(logging.INFO)
+trace_log.propagate = False
+trace_handler = logging.StreamHandler()
+trace_handler.setFormatter(logging.Formatter("%(message)s"))
+trace_log.addHandler(trace_handler)
+trace_job = contextvars.ContextVar("trace_job", default=None)
+
+def trace_span(stage, elapsed, error=None, **fields):
+    if not Config.TRACE_SPANS:
+        return
+    span = {
+        "span": stage,
+        "job": trace_job.get(),
+        "start": round(time.time() - elapsed, 3),
+        "ms": round(elapsed * 1000, 1),
+        "ok": error is None
+    }
+    if error:
+        span["error"] = error
+    span.update(fields)
+    trace_log.info(json.dumps(span))
+
+@contextmanager
+def timed(stage, **fields):
+    """Log a block as a trace span, and record it in stage_latency when it completes"""
+    started = time.monotonic()
+    try:
+        yield
+    except BaseException as e:
+        trace_span(stage, time.monotonic() - started, type(e).__name__, **fields)
+        raise
+    elapsed = time.monotonic() - started
+    stage_latency.observe(stage, elapsed)
+    trace_span(stage, elapsed, **fields)
 
 # ========== UTILITY FUNCTIONS ==========
-async def progress_for_pyrogram(current, total, ud_type, message, start, filename):
-    now = time.time()
-    diff = now - start
-    if round(diff % 2.00) == 0 or current == total:  # Update every 2 seconds
-        percentage = current * 100 / total
-        speed = current / diff if diff > 0 else 0
-        elapsed_time = round(diff) * 1000
-        time_to_completion = round((total - current) / speed) * 1000 if speed > 0 else 0
-        estimated_total_time = elapsed_time + time_to_completion
+progress_stats = {"samples": 0, "edits_sent": 0, "edits_unchanged": 0, "flood_waits": 0}
+
+class JobCancelled(Exception):
+    """The user cancelled the job this transfer belongs to"""
+
+class CancelToken:
+    """Set when the user cancels a job, checked on every progress update"""
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("Cancelled by the user")
+
+class ProgressRenderer:
+    """Redraw one job's progress message at a bounded rate.
+
+    Transfer callbacks only record the latest byte count; a single render
+    task per job turns that into at most one edit every PROGRESS_INTERVAL
+    seconds, skips edits that would not change the text and backs off on
+    FloodWait. Speed and ETA use an exponentially smoothed rate.
+    """
+
+    def __init__(self, message, filename, interval=None, smoothing=0.3, token=None):
+        self.message = message
+        self.filename = filename
+        self.token = token
+        self.interval = interval or Config.PROGRESS_INTERVAL
+        self.smoothing = smoothing
+        self.stage = "🔄 **Processing your file...**"
+        self.current = 0
+        self.total = 0
+        self.rate = None
+        self.sample_at = None
+        self.sample_bytes = 0
+        self.next_edit_at = 0
+        self.last_text = None
+        self.samples = 0
+        self.edits_sent = 0
+        self.changed = asyncio.Event()
+        self.task = None
+        self.directions = 1  # 2 while streaming: every byte is downloaded and uploaded
+        self.stage_bytes = 0  # bytes moved by finished stages
+
+    def start(self):
+        self.changed.set()
+        self.task = asyncio.create_task(self._render_loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        logging.info(
+            f"Progress for {self.filename}: {self.edits_sent} edits sent, "
+            f"{self.samples - self.edits_sent} updates suppressed"
+        )
+
+    def set_title(self, ud_type):
+        """Change the stage line without restarting the speed measurement"""
+        self.stage = ud_type
+        self.changed.set()
+
+    def set_stage(self, ud_type, directions=1):
+        """Start a new transfer stage; speed is measured from scratch"""
+        self.stage_bytes += self.current * self.directions
+        self.directions = directions
+        self.stage = ud_type
+        self.current = 0
+        self.total = 0
+        self.rate = None
+        self.sample_at = None
+        self.changed.set()
+
+    def update(self, current, total):
+        now = time.monotonic()
+        self.samples += 1
+        progress_stats["samples"] += 1
+        if self.sample_at is None:
+            self.sample_at, self.sample_bytes = now, current
+        elif now - self.sample_at >= 0.5:
+            instant = (current - self.sample_bytes) / (now - self.sample_at)
+            self.rate = instant if self.rate is None else self.smoothing * instant + (1 - self.smoothing) * self.rate
+            self.sample_at, self.sample_bytes = now, current
+        self.current, self.total = current, total
+        self.changed.set()
+
+    def transferred(self):
+        """Bytes moved so far over every stage, downloads and uploads counted separately"""
+        return self.stage_bytes + self.current * self.directions
 
-        elapsed_time = TimeFormatter(milliseconds=elapsed_time)
-        estimated_total_time = TimeFormatter(milliseconds=estimated_total_time)
+    def render(self):
+        if not self.total:
+            return self.stage
+        percentage = self.current * 100 / self.total
+        speed = self.rate or 0
+        eta = (self.total - self.current) / speed if speed > 0 else 0
 
         # Progress bar with 10 blocks
         filled_blocks = math.floor(percentage / 10)
         empty_blocks = 10 - filled_blocks
         progress_bar = "▣" * filled_blocks + "□" * empty_blocks
-        
-        progress_text = f"""
-{ud_type}
 
-📄 **File:** `{filename}`
+        return f"""
+{self.stage}
+
+📄 **File:** `{self.filename}`
 
 [{progress_bar}] {round(percentage, 1)}%
 
-💾 **Size:** {humanbytes(current)} / {humanbytes(total)}
+💾 **Size:** {humanbytes(self.current)} / {humanbytes(self.total)}
 
 🚀 **Speed:** {humanbytes(speed)}/s
 
-⏰ **ETA:** {estimated_total_time if estimated_total_time != '' else '0s'}
+⏰ **ETA:** {TimeFormatter(milliseconds=eta * 1000) if speed > 0 else '-'}
 """
-        try:
-            await message.edit(text=progress_text)
-        except MessageNotModified:
-            pass
-        except Exception:
-            pass
+
+    async def _render_loop(self):
+        while True:
+            await self.changed.wait()
+            delay = self.next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.changed.clear()
+
+            text = self.render()
+            if text == self.last_text:
+                progress_stats["edits_unchanged"] += 1
+                continue
+            try:
+                with timed("edit"):
+                    await self.message.edit(text=text)
+            except FloodWait as e:
+                progress_stats["flood_waits"] += 1
+                self.next_edit_at = time.monotonic() + e.value
+                self.changed.set()
+                continue
+            except MessageNotModified:
+                pass
+            except Exception as e:
+                # Not shown, so not counted: the next update tries again after the interval
+                logging.warning(f"Progress edit failed: {e}")
+                self.next_edit_at = time.monotonic() + self.interval
+                continue
+
+            self.last_text = text
+            self.edits_sent += 1
+            progress_stats["edits_sent"] += 1
+            self.next_edit_at = time.monotonic() + self.interval
+
+async def progress_for_pyrogram(current, total, progress):
+    if progress.token:
+        progress.token.check()
+    progress.update(current, total)
 
 def humanbytes(size):    
     if not size:
@@ -112,339 +409,3758 @@ def convert_seconds(seconds):
     else:
         return f"{minutes:02d}:{seconds:02d}"
 
-# Simple thumbnail processing without PIL
-async def process_thumb_async(ph_path):
-    """Simple thumbnail pass-through without PIL"""
+# Files with these extensions are always sent as documents
+FORCE_DOCUMENT_EXTENSIONS = ('.pdf', '.html', '.htm', '.txt', '.doc', '.docx')
+
+def original_extension(file_name, file_type):
+    """Extension of the original file, guessed from its type when the name has none"""
+    if file_name and file_name != 'Unknown':
+        _, ext = os.path.splitext(file_name)
+        if ext:
+            return ext
+    if file_type == 'video':
+        return '.mp4'
+    elif file_type == 'audio':
+        return '.mp3'
+    return '.bin'
+
+# Thumbnail processing (Pillow is optional; without it images pass through unchanged)
+THUMB_MAX_SIDE = 320
+THUMB_MAX_BYTES = 200 * 1024
+thumb_pool = None
+
+def normalize_thumbnail(data):
+    """Re-encode an image as a JPEG Telegram accepts as a thumbnail, runs in a worker process"""
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    else:
+        image = image.convert("RGB")
+    image.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE), Image.LANCZOS)
+
+    for quality in (90, 80, 70, 60, 50, 40, 30):
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=quality, optimize=True)
+        if out.tell() < THUMB_MAX_BYTES:
+            break
+    return out.getvalue()
+
+async def process_thumb_async(data):
+    """Normalize thumbnail bytes in the process pool so the event loop never decodes images"""
+    global thumb_pool
+    if not PILLOW:
+        return data
+    if thumb_pool is None:
+        # Forking a process that already runs Motor's and the loop's threads can deadlock the child
+        thumb_pool = ProcessPoolExecutor(
+            max_workers=Config.THUMB_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+    return await asyncio.get_running_loop().run_in_executor(thumb_pool, normalize_thumbnail, data)
+
+# ========== MEDIA SESSIONS ==========
+MB = 1024 * 1024
+UPLOAD_PART_SIZE = 512 * 1024  # Largest part size Telegram accepts
+BIG_FILE_SIZE = 10 * MB  # Files above this must use saveBigFilePart
+
+async def gather_or_cancel(*tasks):
+    """Wait for all tasks; if one fails, cancel the rest and re-raise"""
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+class MediaSessionPool:
+    """Long-lived media connections per DC, shared by every transfer.
+
+    Pyrogram opens and closes a media session per file; keeping them open
+    saves the handshake (and the auth export for foreign DCs) on every job
+    and lets one file use several connections at once.
+    """
+
+    def __init__(self):
+        self.sessions = {}  # dc_id -> [Session]
+        self.locks = {}
+
+    async def _create(self, client, dc_id):
+        test_mode = await client.storage.test_mode()
+        if dc_id == await client.storage.dc_id():
+            session = Session(client, dc_id, await client.storage.auth_key(), test_mode, is_media=True)
+            await session.start()
+            return session
+
+        session = Session(client, dc_id, await Auth(client, dc_id, test_mode).create(), test_mode, is_media=True)
+        await session.start()
+        for _ in range(3):
+            exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            try:
+                await session.invoke(raw.functions.auth.ImportAuthorization(
+                    id=exported_auth.id,
+                    bytes=exported_auth.bytes
+                ))
+            except AuthBytesInvalid:
+                continue
+            return session
+        await session.stop()
+        raise AuthBytesInvalid
+
+    async def get(self, client, dc_id, count):
+        """Return ``count`` started sessions to ``dc_id``, opening missing ones in parallel"""
+        lock = self.locks.setdefault(dc_id, asyncio.Lock())
+        async with lock:
+            pool = self.sessions.setdefault(dc_id, [])
+            missing = count - len(pool)
+            if missing > 0:
+                created = await asyncio.gather(
+                    *(self._create(client, dc_id) for _ in range(missing)),
+                    return_exceptions=True
+                )
+                pool.extend(session for session in created if isinstance(session, Session))
+                errors = [e for e in created if isinstance(e, BaseException)]
+                if errors and not pool:
+                    raise errors[0]
+                for e in errors:
+                    logging.warning(f"Could not open media session to DC{dc_id}: {e}")
+            return pool[:count]
+
+    async def home(self, client, count):
+        return await self.get(client, await client.storage.dc_id(), count)
+
+    async def close(self):
+        for pool in self.sessions.values():
+            for session in pool:
+                await session.stop()
+        self.sessions.clear()
+
+media_sessions = MediaSessionPool()
+
+# ========== STORAGE MANAGER ==========
+DOWNLOAD_DIR = "downloads"
+
+class StorageFull(Exception):
     pass
 
-# ========== DATABASE CLASS ==========
-class Database:
-    def __init__(self, uri, database_name):
-        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
-        self.db = self._client[database_name]
-        self.col = self.db.users
+def disk_usage(path):
+    """Bytes actually allocated on disk under path"""
+    if not os.path.isdir(path):
+        return os.lstat(path).st_blocks * 512
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+            except OSError:
+                pass
+    return total
 
-    async def set_thumbnail(self, user_id, file_id):
-        await self.col.update_one(
-            {"_id": user_id},
-            {"$set": {"file_id": file_id}},
-            upsert=True
+class StorageRoot:
+    """One directory job files may be placed in, with its own quota"""
+    __slots__ = ("name", "path", "quota", "max_file", "reserved")
+
+    def __init__(self, name, path, quota, max_file=None):
+        self.name = name
+        self.path = path
+        self.quota = quota
+        self.max_file = max_file
+        self.reserved = 0
+
+    def free(self):
+        return shutil.disk_usage(self.path).free
+
+    def used(self):
+        return disk_usage(self.path)
+
+class StorageManager:
+    """Per-job working directories with disk space reserved up front.
+
+    A job's files live in ``<root>/<job_id>/``. Its checkpoint always stays
+    under the home root, while the data of small jobs may go to tmpfs. A
+    reservation has to fit both the root's quota and the free space on its
+    device, otherwise the job waits for space and is refused after
+    STORAGE_WAIT_SECONDS. Queued jobs reserve through try_reserve() before
+    they are given a slot, so the wait happens in the queue. Directories of
+    jobs nobody holds are swept away.
+    """
+
+    def __init__(self, home, tmpfs=None, min_free=0, wait_timeout=300, sweep_interval=1800):
+        self.home = home
+        self.roots = [tmpfs, home] if tmpfs else [home]
+        self.min_free = min_free
+        self.wait_timeout = wait_timeout
+        self.sweep_interval = sweep_interval
+        self.active = set()
+        self.reservations = {}
+        self.waiting = {}  # job_id -> when it first found no space
+        self.space_freed = asyncio.Condition()
+        self.counters = {"reservations": 0, "waits": 0, "refused": 0, "swept_files": 0, "swept_bytes": 0}
+        self.sweeper = None
+        for root in self.roots:
+            os.makedirs(root.path, exist_ok=True)
+
+    def job_dir(self, job_id, root=None):
+        return os.path.join((root or self.home).path, job_id)
+
+    def claim(self, job_id):
+        """Protect a job's directories from the sweeper while the job exists"""
+        self.active.add(job_id)
+
+    def _candidates(self, size):
+        return [root for root in self.roots if root.max_file is None or size <= root.max_file]
+
+    def _fits(self, root, size):
+        return root.reserved + size <= root.quota and root.free() - size >= self.min_free
+
+    def _place(self, job_id, size, root):
+        root.reserved += size
+        self.reservations[job_id] = (root, size)
+        self.counters["reservations"] += 1
+        os.makedirs(self.job_dir(job_id, root), exist_ok=True)
+        return os.path.join(self.job_dir(job_id, root), "data.part")
+
+    def _ordered_candidates(self, job_id, size):
+        # Data an earlier attempt left behind stays where it is
+        candidates = self._candidates(size)
+        candidates.sort(key=lambda root: not os.path.exists(os.path.join(self.job_dir(job_id, root), "data.part")))
+        return candidates
+
+    def try_reserve(self, job_id, size):
+        """Reserve without waiting; False while the job should stay queued for space.
+
+        Once a job has waited STORAGE_WAIT_SECONDS, or can never fit, this
+        returns True anyway and reserve() refuses it with StorageFull.
+        """
+        if job_id in self.reservations:
+            return True
+        candidates = self._ordered_candidates(job_id, size)
+        if not any(size <= root.quota for root in candidates):
+            return True
+        root = next((root for root in candidates if self._fits(root, size)), None)
+        if root:
+            self.waiting.pop(job_id, None)
+            self._place(job_id, size, root)
+            return True
+        if job_id not in self.waiting:
+            self.waiting[job_id] = time.monotonic()
+            self.counters["waits"] += 1
+        return time.monotonic() - self.waiting[job_id] >= self.wait_timeout
+
+    async def reserve(self, job_id, size):
+        """Reserve size bytes for a job and return the path for its data file"""
+        if job_id in self.reservations:
+            root, _ = self.reservations[job_id]
+            return os.path.join(self.job_dir(job_id, root), "data.part")
+
+        candidates = self._ordered_candidates(job_id, size)
+        if not any(size <= root.quota for root in candidates):
+            self.waiting.pop(job_id, None)
+            self.counters["refused"] += 1
+            raise StorageFull(f"File is larger than the {humanbytes(self.home.quota)} storage quota")
+
+        # Time already spent waiting in the queue counts towards the limit
+        deadline = self.waiting.pop(job_id, time.monotonic()) + self.wait_timeout
+        async with self.space_freed:
+            while True:
+                root = next((root for root in candidates if self._fits(root, size)), None)
+                if root:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters["refused"] += 1
+                    raise StorageFull("Not enough free storage right now, please try again later")
+                self.counters["waits"] += 1
+                # Free space can also come back from outside the bot, so look again now and then
+                try:
+                    await asyncio.wait_for(self.space_freed.wait(), min(remaining, 5))
+                except asyncio.TimeoutError:
+                    pass
+
+        return self._place(job_id, size, root)
+
+    async def release(self, job_id, keep_files=False):
+        """Give back a job's reservation and, unless kept for a resume, its files"""
+        self.active.discard(job_id)
+        self.waiting.pop(job_id, None)
+        reservation = self.reservations.pop(job_id, None)
+        if reservation:
+            root, size = reservation
+            root.reserved -= size
+        if not keep_files:
+            for root in self.roots:
+                shutil.rmtree(self.job_dir(job_id, root), ignore_errors=True)
+        async with self.space_freed:
+            self.space_freed.notify_all()
+
+    def sweep(self, keep=()):
+        """Remove everything under the roots that no job holds"""
+        for root in self.roots:
+            for name in os.listdir(root.path):
+                if name in self.active or name in keep:
+                    continue
+                path = os.path.join(root.path, name)
+                try:
+                    size = disk_usage(path)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except OSError as e:
+                    logging.warning(f"Could not sweep {path}: {e}")
+                    continue
+                self.counters["swept_files"] += 1
+                self.counters["swept_bytes"] += size
+                logging.info(f"Swept orphaned {path} ({humanbytes(size)})")
+
+    def start(self):
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.sweep)
+            except Exception as e:
+                logging.error(f"Storage sweep failed: {e}")
+
+    def stats(self):
+        return {
+            root.name: {
+                "path": root.path,
+                "reserved": root.reserved,
+                "quota": root.quota,
+                "used": root.used(),
+                "free": root.free()
+            }
+            for root in self.roots
+        }
+
+storage = StorageManager(
+    StorageRoot("disk", DOWNLOAD_DIR, Config.STORAGE_QUOTA_MB * MB),
+    tmpfs=StorageRoot(
+        "tmpfs", os.path.join(Config.TMPFS_DIR, "rebot"),
+        Config.TMPFS_QUOTA_MB * MB, Config.TMPFS_MAX_MB * MB
+    ) if Config.TMPFS_DIR else None,
+    min_free=Config.STORAGE_MIN_FREE_MB * MB,
+    wait_timeout=Config.STORAGE_WAIT_SECONDS,
+    sweep_interval=Config.STORAGE_SWEEP_MINUTES * 60
+)
+
+# ========== TRANSFER CHECKPOINTS ==========
+class TransferCheckpoint:
+    """How far one job's transfer got, persisted in the job's directory.
+
+    Download chunks are recorded once they are written and upload parts once
+    Telegram has acknowledged them, so a retry or a restart carries on from
+    there. The job itself is stored too, so it can be resubmitted on startup.
+    """
+
+    def __init__(self, job_id, job=None, created_at=None):
+        self.job_id = job_id
+        self.job = job or {}
+        self.path = os.path.join(storage.job_dir(job_id), "checkpoint.json")
+        self.data_path = None
+        self.created_at = created_at or time.time()
+        self.chunk_size = None
+        self.chunks = set()
+        self.upload_file_id = None
+        self.upload_total_parts = None
+        self.upload_parts = set()
+        self.saved_at = 0.0
+        self.dirty = False
+
+    def to_doc(self):
+        return {
+            "job_id": self.job_id,
+            "job": self.job,
+            "created_at": self.created_at,
+            "data_path": self.data_path,
+            "chunk_size": self.chunk_size,
+            "chunks": sorted(self.chunks),
+            "upload_file_id": self.upload_file_id,
+            "upload_total_parts": self.upload_total_parts,
+            "upload_parts": sorted(self.upload_parts)
+        }
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            doc = json.load(f)
+        checkpoint = cls(doc["job_id"], doc["job"], doc["created_at"])
+        checkpoint.data_path = doc["data_path"]
+        checkpoint.chunk_size = doc["chunk_size"]
+        checkpoint.chunks = set(doc["chunks"])
+        checkpoint.upload_file_id = doc["upload_file_id"]
+        checkpoint.upload_total_parts = doc["upload_total_parts"]
+        checkpoint.upload_parts = set(doc["upload_parts"])
+        return checkpoint
+
+    def resume_download(self, chunk_size, file_size):
+        """Return offsets already on disk, starting over if they cannot be trusted"""
+        usable = (
+            self.chunk_size == chunk_size
+            and self.data_path
+            and os.path.exists(self.data_path)
+            and os.path.getsize(self.data_path) == file_size
         )
+        if not usable:
+            self.chunk_size = chunk_size
+            self.chunks = set()
+        return set(self.chunks)
 
-    async def get_thumbnail(self, user_id):
-        user = await self.col.find_one({"_id": user_id})
-        return user.get("file_id") if user else None
+    def mark_chunk(self, offset):
+        self.chunks.add(offset)
+        self.save()
 
-# Initialize database
-db = Database(Config.DB_URL, Config.DB_NAME)
+    def resume_upload(self, file_id, total_parts):
+        """Return (file_id, parts already acknowledged) for an upload"""
+        if self.upload_file_id is None or self.upload_total_parts != total_parts:
+            self.upload_file_id = file_id
+            self.upload_total_parts = total_parts
+            self.upload_parts = set()
+        return self.upload_file_id, set(self.upload_parts)
 
-# ========== BOT SETUP ==========
-if not all([Config.API_ID, Config.API_HASH, Config.BOT_TOKEN]):
-    print("❌ ERROR: Missing API credentials! Please set environment variables.")
-    print(f"API_ID: {'✅' if Config.API_ID else '❌'}")
-    print(f"API_HASH: {'✅' if Config.API_HASH else '❌'}")
-    print(f"BOT_TOKEN: {'✅' if Config.BOT_TOKEN else '❌'}")
-    exit(1)
+    def mark_part(self, file_part):
+        self.upload_parts.add(file_part)
+        self.save()
 
-app = Client(
-    "rename_bot",
-    api_id=Config.API_ID,
-    api_hash=Config.API_HASH,
-    bot_token=Config.BOT_TOKEN
+    def reset_upload(self):
+        self.upload_file_id = None
+        self.upload_parts = set()
+        self.save(force=True)
+
+    def save(self, force=False):
+        """Write the checkpoint atomically, at most once per CHECKPOINT_INTERVAL"""
+        self.dirty = True
+        now = time.monotonic()
+        if not force and now - self.saved_at < Config.CHECKPOINT_INTERVAL:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_doc(), f)
+        os.replace(tmp_path, self.path)
+        self.saved_at = now
+        self.dirty = False
+
+    def flush(self):
+        if self.dirty:
+            try:
+                self.save(force=True)
+            except OSError as e:
+                logging.warning(f"Could not save checkpoint {self.job_id}: {e}")
+
+TRANSIENT_ERRORS = (
+    OSError, TimeoutError, asyncio.TimeoutError, FloodWait, InternalServerError, FilePartMissing
 )
 
-# ========== GLOBAL VARIABLES ==========
-user_states = {}
+def retry_delay(attempt, error=None):
+    """Exponential backoff with full jitter, on top of any FloodWait"""
+    delay = random.uniform(0, Config.RETRY_BACKOFF * 2 ** attempt)
+    if isinstance(error, FloodWait):
+        delay += error.value
+    return delay
 
-# ========== THUMBNAIL MANAGEMENT ==========
-@app.on_message(filters.private & filters.command(["view_thumb", "viewthumbnail"]))
-async def view_thumbnail(client, message):
-    thumbnail = await db.get_thumbnail(message.from_user.id)
-    if thumbnail:
-        await client.send_photo(message.chat.id, thumbnail, caption="**Your Current Thumbnail**")
-    else:
-        await message.reply_text("**You don't have any thumbnail set.**")
+# ========== PARALLEL DOWNLOAD ==========
+class CdnRedirect(Exception):
+    """The file lives on a CDN DC; only Pyrogram's own downloader handles those"""
 
-@app.on_message(filters.private & filters.command(["del_thumb", "deletethumbnail"]))
-async def delete_thumbnail(client, message):
-    await db.set_thumbnail(message.from_user.id, None)
-    await message.reply_text("**Thumbnail deleted successfully!**")
+download_stats = {"bytes": 0, "parallel_files": 0, "single_files": 0, "connections": {}}  # (dc_id, n) -> bytes, seconds
 
-@app.on_message(filters.private & filters.photo)
-async def save_thumbnail(client, message):
-    await db.set_thumbnail(message.from_user.id, message.photo.file_id)
-    await message.reply_text("**Thumbnail saved successfully!**")
+def message_media(message):
+    return getattr(message, message.media.value)
 
-# ========== CANCEL COMMAND ==========
-@app.on_message(filters.private & filters.command("cancel"))
-async def cancel_command(client, message):
-    user_id = message.from_user.id
-    if user_id in user_states:
-        del user_states[user_id]
-        await message.reply_text("**✅ Process cancelled successfully!**")
-    else:
-        await message.reply_text("**❌ No active process to cancel.**")
+class ChunkFetcher:
+    """Fetch byte ranges of one file over several media connections at once.
 
-# ========== START COMMAND ==========
-@app.on_message(filters.private & filters.command("start"))
-async def start_command(client, message):
-    await message.reply_text(
-        "**👋 Hello! I'm a File Rename Bot**\n\n"
-        "**How to use:**\n"
-        "1. Send me any file (document/video/audio)\n"
-        "2. Click 'Rename' button\n"
-        "3. Enter new filename\n"
-        "4. Select upload type\n\n"
-        "**Thumbnail Commands:**\n"
-        "• Send a photo to set thumbnail\n"
-        "• /view_thumb - View current thumbnail\n"
-        "• /del_thumb - Delete thumbnail\n\n"
-        "**Other Commands:**\n"
-        "• /cancel - Cancel current process"
-    )
+    Workers pull the next offset from a shared iterator and hand each chunk
+    to ``sink(offset, data)`` as soon as it arrives, so chunks complete out
+    of order. Per-connection throughput is kept in ``self.connection_stats``.
+    """
 
-# ========== FILE RENAME HANDLER ==========
-@app.on_message(filters.private & (filters.document | filters.video | filters.audio))
-async def handle_file(client, message):
-    user_id = message.from_user.id
-    
-    # Block if user already has active process
-    if user_id in user_states:
-        await message.reply_text("**❌ Please complete your current process first!**\nUse /cancel to cancel.")
-        return
-    
-    # Get file info
-    if message.document:
-        file = message.document
-        file_type = "document"
-        duration = 0
-    elif message.video:
-        file = message.video
-        file_type = "video"
-        duration = getattr(file, 'duration', 0)
-    elif message.audio:
-        file = message.audio
-        file_type = "audio"
-        duration = getattr(file, 'duration', 0)
-    else:
-        return
+    def __init__(self, client, media, file_size, connections=None, chunk_size=None):
+        self.client = client
+        self.file_size = file_size
+        self.file_id = FileId.decode(media.file_id)
+        self.location = raw.types.InputDocumentFileLocation(
+            id=self.file_id.media_id,
+            access_hash=self.file_id.access_hash,
+            file_reference=self.file_id.file_reference,
+            thumb_size=self.file_id.thumbnail_size
+        )
+        self.connections = connections or Config.DOWNLOAD_CONNECTIONS
+        self.chunk_size = chunk_size or Config.DOWNLOAD_CHUNK_KB * 1024
+        if self.chunk_size % 4096 or MB % self.chunk_size:
+            raise ValueError("Download chunk size must be a multiple of 4 KB that divides 1 MB")
+        self.offsets = iter(range(0, file_size, self.chunk_size))
+        self.connection_stats = []
+        self.done = 0
 
-    file_name = getattr(file, 'file_name', 'Unknown')
-    file_size = humanbytes(getattr(file, 'file_size', 0))
-    
-    # Store file info with duration
-    user_states[user_id] = {
-        'file_info': {
-            'file_name': file_name,
-            'file_size': file_size,
-            'file_type': file_type,
-            'duration': duration,
-            'original_message': message,
-            'file_id': file.file_id
-        },
-        'step': 'awaiting_rename'
-    }
+    def resume(self, done_offsets):
+        """Leave out chunks that an earlier attempt already fetched"""
+        self.offsets = iter([o for o in range(0, self.file_size, self.chunk_size) if o not in done_offsets])
+        self.done = sum(min(self.chunk_size, self.file_size - o) for o in done_offsets)
 
-    # Show file info with buttons - include duration
-    duration_text = convert_seconds(duration) if duration > 0 else "Not available"
-    
-    info_text = f"""**📁 File Information:**
+    async def _fetch(self, session, offset):
+        for attempt in range(3):
+            try:
+                return await session.invoke(
+                    raw.functions.upload.GetFile(location=self.location, offset=offset, limit=self.chunk_size),
+                    sleep_threshold=30
+                )
+            except (OSError, TimeoutError) as e:
+                if attempt == 2:
+                    raise
+                logging.warning(f"Chunk at {offset} failed ({e}), retrying")
+                await asyncio.sleep(1 + attempt)
 
-**Name:** `{file_name}`
-**Size:** `{file_size}`
-**Type:** `{file_type.title()}`
-**Duration:** `{duration_text}`
+    async def _worker(self, session, stats, sink, progress, progress_args):
+        for offset in self.offsets:
+            started = time.monotonic()
+            r = await self._fetch(session, offset)
+            if isinstance(r, raw.types.upload.FileCdnRedirect):
+                raise CdnRedirect()
+            stats["seconds"] += time.monotonic() - started
+            stats["bytes"] += len(r.bytes)
 
-**Click RENAME to continue.**"""
+            await sink(offset, r.bytes)
+            self.done += len(r.bytes)
+            download_stats["bytes"] += len(r.bytes)
+            if progress:
+                await progress(self.done, self.file_size, *progress_args)
 
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔄 Rename", callback_data="start_rename")]
-        # Removed cancel button
-    ])
-    
-    await message.reply_text(info_text, reply_markup=keyboard)
+    async def run(self, sink, progress=None, progress_args=()):
+        sessions = await media_sessions.get(self.client, self.file_id.dc_id, self.connections)
+        self.connection_stats = [{"bytes": 0, "seconds": 0.0} for _ in sessions]
+        started = time.monotonic()
+        try:
+            await gather_or_cancel(*(
+                asyncio.create_task(self._worker(session, stats, sink, progress, progress_args))
+                for session, stats in zip(sessions, self.connection_stats)
+            ))
+        finally:
+            for n, stats in enumerate(self.connection_stats):
+                total = download_stats["connections"].setdefault((self.file_id.dc_id, n), {"bytes": 0, "seconds": 0.0})
+                total["bytes"] += stats["bytes"]
+                total["seconds"] += stats["seconds"]
+        elapsed = time.monotonic() - started
+        rates = ", ".join(
+            f"{humanbytes(s['bytes'] / s['seconds'] if s['seconds'] else 0)}/s"
+            for s in self.connection_stats
+        )
+        logging.info(
+            f"Fetched {humanbytes(self.done)} in {elapsed:.1f}s over {len(sessions)} "
+            f"connections to DC{self.file_id.dc_id} ({rates})"
+        )
 
-# ========== CALLBACK HANDLERS ==========
-@app.on_callback_query(filters.regex("^start_rename$"))
-async def start_rename_callback(client, callback_query):
-    user_id = callback_query.from_user.id
-    
-    if user_id not in user_states:
-        await callback_query.answer("Session expired! Send file again.", show_alert=True)
-        return
-    
-    user_states[user_id]['step'] = 'awaiting_filename'
-    
-    # Delete the rename prompt message
-    try:
-        await callback_query.message.delete()
-    except:
-        pass
-    
-    # Ask for filename directly without buttons
-    ask_msg = await callback_query.message.reply_text(
-        "**📝 Please reply with the new filename:**\n\n"
-        "**Note:** Don't include file extension\n"
-        "Example: `my_renamed_file`\n\n"
-        "💡 *You can reply to this message*"
-    )
-    
-    # Store the ask message ID for auto-reply
-    user_states[user_id]['ask_message_id'] = ask_msg.id
-    
-    await callback_query.answer()
+    async def download_to(self, path, progress=None, progress_args=(), checkpoint=None):
+        """Download into a preallocated file with positional writes.
 
-@app.on_callback_query(filters.regex("^upload_(document|video)$"))
-async def upload_type_callback(client, callback_query):
-    user_id = callback_query.from_user.id
-    upload_type = callback_query.data.split("_")[1]
-    
-    if user_id not in user_states:
-        await callback_query.answer("Session expired!", show_alert=True)
-        return
-    
-    user_data = user_states[user_id]
-    
-    try:
-        # Delete the selection message
+        With a checkpoint, chunks written by an earlier attempt are kept and
+        the partial file survives a failure.
+        """
+        loop = asyncio.get_running_loop()
+        done = checkpoint.resume_download(self.chunk_size, self.file_size) if checkpoint else set()
+        self.resume(done)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | (0 if done else os.O_TRUNC), 0o644)
         try:
-            await callback_query.message.delete()
-        except:
-            pass
-        
-        file_info = user_data['file_info']
-        new_filename = user_data['new_filename']
-        original_message = file_info['original_message']
-        original_duration = file_info['duration']
-        
-        # Get original extension
-        original_name = file_info['file_name']
-        if not original_name or original_name == 'Unknown':
-            if file_info['file_type'] == 'video':
-                original_ext = '.mp4'
-            elif file_info['file_type'] == 'audio':
-                original_ext = '.mp3'
+            os.ftruncate(fd, self.file_size)
+
+            async def write(offset, data):
+                await loop.run_in_executor(None, os.pwrite, fd, data, offset)
+                if checkpoint:
+                    checkpoint.mark_chunk(offset)
+
+            await self.run(write, progress, progress_args)
+        except BaseException:
+            os.close(fd)
+            if checkpoint:
+                checkpoint.flush()
             else:
-                original_ext = '.bin'
+                os.remove(path)
+            raise
+        os.close(fd)
+        return path
+
+def use_parallel_download(file_size):
+    return Config.DOWNLOAD_CONNECTIONS > 1 and file_size >= Config.PARALLEL_DOWNLOAD_MIN_MB * MB
+
+async def download_sequential(client, message, file_size, path, progress, checkpoint=None):
+    """Stream a message's media to path in 1 MB chunks, resuming after the last one on disk"""
+    loop = asyncio.get_running_loop()
+    done = checkpoint.resume_download(MB, file_size) if checkpoint else set()
+    start = 0
+    while start * MB in done:
+        start += 1
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | (0 if start else os.O_TRUNC), 0o644)
+    try:
+        os.ftruncate(fd, file_size)
+        offset = min(start * MB, file_size)
+        if offset < file_size:
+            async for chunk in client.stream_media(message, offset=start):
+                await loop.run_in_executor(None, os.pwrite, fd, chunk, offset)
+                if checkpoint:
+                    checkpoint.mark_chunk(offset)
+                offset += len(chunk)
+                download_stats["bytes"] += len(chunk)
+                await progress_for_pyrogram(offset, file_size, progress)
+        if offset != file_size:
+            raise Exception(f"Download ended early ({humanbytes(offset)} of {humanbytes(file_size)})")
+    except BaseException:
+        os.close(fd)
+        if checkpoint:
+            checkpoint.flush()
         else:
-            _, original_ext = os.path.splitext(original_name)
-            if not original_ext:
-                if file_info['file_type'] == 'video':
-                    original_ext = '.mp4'
-                elif file_info['file_type'] == 'audio':
-                    original_ext = '.mp3'
-                else:
-                    original_ext = '.bin'
-        
-        final_filename = f"{new_filename}{original_ext}"
-        
-        # Download path
-        download_path = f"downloads/{final_filename}"
-        os.makedirs("downloads", exist_ok=True)
-        
-        # Create progress message
-        progress_msg = await callback_query.message.reply_text("🔄 Processing your file...")
-        
-        # Download file with progress
-        start_time = time.time()
-        
-        file_path = await client.download_media(
-            original_message,
-            file_name=download_path,
-            progress=progress_for_pyrogram,
-            progress_args=("📥 **Downloading File**", progress_msg, start_time, final_filename)
-        )
-        
-        if not file_path or not os.path.exists(file_path):
-            raise Exception("Download failed")
+            os.remove(path)
+        raise
+    os.close(fd)
+    return path
+
+async def download_file(client, message, file_size, path, progress, checkpoint=None):
+    """Download a message's media to path, over several connections when it is large"""
+    if use_parallel_download(file_size):
+        try:
+            result = await ChunkFetcher(client, message_media(message), file_size).download_to(
+                path, progress_for_pyrogram, (progress,), checkpoint
+            )
+            download_stats["parallel_files"] += 1
+            return result
+        except CdnRedirect:
+            logging.info("File is served from a CDN, falling back to a single stream")
+
+    download_stats["single_files"] += 1
+    if file_size:
+        return await download_sequential(client, message, file_size, path, progress, checkpoint)
+    return await client.download_media(
+        message,
+        file_name=path,
+        progress=progress_for_pyrogram,
+        progress_args=(progress,)
+    )
+
+# ========== PARALLEL UPLOAD ==========
+upload_stats = {"bytes": 0, "parts": 0, "retries": 0, "files": 0}
+
+class PartUploader:
+    """Upload numbered file parts concurrently over a pool of media connections.
+
+    The number of parts in flight adapts to what the connections deliver:
+    it grows by one while throughput keeps improving, steps back when it
+    drops and halves on errors. Small files get their MD5 computed as parts
+    go past, which requires them to arrive in order. Parts a checkpoint
+    records as acknowledged are not sent again.
+    """
+
+    def __init__(self, client, file_size, file_name, progress=None, progress_args=(), checkpoint=None):
+        self.client = client
+        self.file_size = file_size
+        self.file_name = file_name
+        self.progress = progress
+        self.progress_args = progress_args
+        self.file_id = client.rnd_id()
+        self.total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        self.is_big = file_size > BIG_FILE_SIZE
+        self.md5_sum = None if self.is_big else md5()
+        self.next_hashed_part = 0
+        self.limit = Config.UPLOAD_START_INFLIGHT
+        self.in_flight = 0
+        self.slots = asyncio.Condition()
+        self.error = None
+        self.uploaded = 0
+        self.window_parts = 0
+        self.window_bytes = 0
+        self.window_started = time.monotonic()
+        self.last_rate = None
+        self.sessions = []
+        self.checkpoint = checkpoint
+        self.skip = set()
+        if checkpoint:
+            self.file_id, self.skip = checkpoint.resume_upload(self.file_id, self.total_parts)
+            self.uploaded = sum(min(UPLOAD_PART_SIZE, file_size - p * UPLOAD_PART_SIZE) for p in self.skip)
+
+    def _rpc(self, file_part, data):
+        if self.is_big:
+            return raw.functions.upload.SaveBigFilePart(
+                file_id=self.file_id,
+                file_part=file_part,
+                file_total_parts=self.total_parts,
+                bytes=data
+            )
+        return raw.functions.upload.SaveFilePart(
+            file_id=self.file_id,
+            file_part=file_part,
+            bytes=data
+        )
+
+    def _adapt(self, size):
+        """Re-tune the in-flight limit once per window of completed parts"""
+        self.window_parts += 1
+        self.window_bytes += size
+        if self.window_parts < max(4, self.limit):
+            return
+        now = time.monotonic()
+        rate = self.window_bytes / max(now - self.window_started, 1e-6)
+        if self.last_rate is None or rate > self.last_rate * 1.05:
+            self.limit = min(Config.UPLOAD_MAX_INFLIGHT, self.limit + 1)
+        elif rate < self.last_rate * 0.8:
+            self.limit = max(1, self.limit - 1)
+        self.last_rate = rate
+        self.window_parts = self.window_bytes = 0
+        self.window_started = now
+
+    async def send_part(self, file_part, data):
+        session = self.sessions[file_part % len(self.sessions)]
+        for attempt in range(5):
+            try:
+                if not await session.invoke(self._rpc(file_part, data)):
+                    raise Exception(f"Telegram rejected upload part {file_part}")
+                break
+            except FloodWait as e:
+                wait = e.value
+            except (OSError, TimeoutError) as e:
+                if attempt == 4:
+                    raise
+                wait = 2 ** attempt
+                logging.warning(f"Upload part {file_part} failed ({e}), retrying")
+            upload_stats["retries"] += 1
+            self.limit = max(1, self.limit // 2)
+            await asyncio.sleep(wait)
+        else:
+            raise Exception(f"Upload part {file_part} kept failing")
+
+        if self.checkpoint:
+            self.checkpoint.mark_part(file_part)
+        self.uploaded += len(data)
+        upload_stats["bytes"] += len(data)
+        upload_stats["parts"] += 1
+        self._adapt(len(data))
+        if self.progress:
+            await self.progress(min(self.uploaded, self.file_size), self.file_size, *self.progress_args)
+
+    async def _run_part(self, file_part, data):
+        try:
+            await self.send_part(file_part, data)
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            async with self.slots:
+                self.in_flight -= 1
+                self.slots.notify_all()
+
+    async def upload(self, parts):
+        """Upload every (file_part, data) from an async iterator and return the InputFile"""
+        self.sessions = await media_sessions.home(self.client, Config.UPLOAD_CONNECTIONS)
+        tasks = set()
+        started = time.monotonic()
+        try:
+            async for file_part, data in parts:
+                if self.md5_sum is not None:
+                    if file_part != self.next_hashed_part:
+                        raise Exception("Parts of a small file must be uploaded in order")
+                    self.md5_sum.update(data)
+                    self.next_hashed_part += 1
+                if file_part in self.skip:
+                    continue
+
+                async with self.slots:
+                    await self.slots.wait_for(lambda: self.in_flight < self.limit or self.error)
+                    if self.error:
+                        raise self.error
+                    self.in_flight += 1
+                task = asyncio.create_task(self._run_part(file_part, data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            await asyncio.gather(*tasks)
+            if self.error:
+                raise self.error
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        upload_stats["files"] += 1
+        elapsed = time.monotonic() - started
+        logging.info(
+            f"Uploaded {humanbytes(self.uploaded)} in {elapsed:.1f}s "
+            f"({humanbytes(self.uploaded / elapsed if elapsed else 0)}/s, settled at {self.limit} parts in flight)"
+        )
+
+        if self.is_big:
+            return raw.types.InputFileBig(id=self.file_id, parts=self.total_parts, name=self.file_name)
+        return raw.types.InputFile(
+            id=self.file_id,
+            parts=self.total_parts,
+            name=self.file_name,
+            md5_checksum=self.md5_sum.hexdigest()
+        )
+
+async def read_parts(path):
+    """Read a local file part by part without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for file_part in range(math.ceil(os.fstat(fd).st_size / UPLOAD_PART_SIZE)):
+            yield file_part, await loop.run_in_executor(
+                None, os.pread, fd, UPLOAD_PART_SIZE, file_part * UPLOAD_PART_SIZE
+            )
+    finally:
+        os.close(fd)
+
+async def upload_file(client, path, file_name, progress=None, progress_args=(), checkpoint=None):
+    """Upload a local file and return (InputFile, repair) for send_uploaded_media"""
+    file_size = os.path.getsize(path)
+    if not file_size:
+        raise Exception("File size equals to 0 B")
+    uploader = PartUploader(client, file_size, file_name, progress, progress_args, checkpoint)
+    input_file = await uploader.upload(read_parts(path))
+
+    async def repair(file_part):
+        with open(path, "rb") as f:
+            f.seek(file_part * UPLOAD_PART_SIZE)
+            await uploader.send_part(file_part, f.read(UPLOAD_PART_SIZE))
+
+    return input_file, repair
+
+# ========== IN-MEMORY TRANSFER ==========
+class MemoryBudget:
+    """Bytes of file data the in-memory path may hold across all jobs"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.counters = {"files": 0, "overflows": 0}
+
+    def reserve(self, size):
+        if self.in_use + size > self.limit:
+            self.counters["overflows"] += 1
+            return False
+        self.in_use += size
+        self.peak = max(self.peak, self.in_use)
+        self.counters["files"] += 1
+        return True
+
+    def release(self, size):
+        self.in_use -= size
+
+memory_budget = MemoryBudget(Config.IN_MEMORY_TOTAL_MB * MB)
+
+def use_memory_path(file_size):
+    return 0 < file_size <= Config.IN_MEMORY_MAX_MB * MB
+
+def uses_disk(file_size):
+    """Whether a transfer of this size goes through a file in the job's directory"""
+    return not (Config.STREAM_MODE and file_size) and not use_memory_path(file_size)
+
+async def buffer_parts(buffer):
+    view = buffer.getbuffer()
+    try:
+        for file_part in range(math.ceil(len(view) / UPLOAD_PART_SIZE)):
+            yield file_part, bytes(view[file_part * UPLOAD_PART_SIZE:(file_part + 1) * UPLOAD_PART_SIZE])
+    finally:
+        view.release()
+
+async def transfer_in_memory(client, chat_id, original_message, file_size, final_filename, upload_type, duration, thumb_path, progress, width=0, height=0):
+    """Download a small file into a BytesIO and upload it straight from there"""
+    progress.set_stage("📥 **Downloading File**")
+    with timed("download"):
+        buffer = await client.download_media(
+            original_message,
+            in_memory=True,
+            progress=progress_for_pyrogram,
+            progress_args=(progress,)
+        )
+    if not buffer:
+        # Pyrogram swallows errors raised by the progress callback, cancellation included
+        if progress.token:
+            progress.token.check()
+        raise Exception("Download failed")
+    buffer.name = final_filename
+    download_stats["bytes"] += file_size
+
+    progress.set_stage("📤 **Uploading File**")
+    uploader = PartUploader(client, buffer.getbuffer().nbytes, final_filename, progress_for_pyrogram, (progress,))
+    with timed("upload"):
+        input_file = await uploader.upload(buffer_parts(buffer))
+
+    async def repair(file_part):
+        start = file_part * UPLOAD_PART_SIZE
+        await uploader.send_part(file_part, buffer.getvalue()[start:start + UPLOAD_PART_SIZE])
+
+    return await send_uploaded_media(
+        client, chat_id, input_file, final_filename, upload_type,
+        thumb_path, duration, repair=repair, width=width, height=height
+    )
+
+# ========== STREAMING TRANSFER ==========
+class StreamingUpload:
+    """Upload a message's media while it is still being downloaded.
+
+    Downloaded chunks are cut into upload parts and pushed through a bounded
+    queue, so only a fixed window of parts is ever held in memory and nothing
+    touches the disk. Large files are fetched over several connections, and
+    on a resumed attempt chunks whose parts were all acknowledged are skipped.
+    """
+
+    def __init__(self, client, message, file_size, file_name, progress=None, progress_args=(), checkpoint=None):
+        self.client = client
+        self.message = message
+        self.file_size = file_size
+        self.file_name = file_name
+        self.total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        self.is_big = file_size > BIG_FILE_SIZE
+        self.queue = asyncio.Queue(maxsize=Config.STREAM_BUFFER_PARTS)
+        self.uploader = PartUploader(client, file_size, file_name, progress, progress_args, checkpoint)
+        self.downloaded = 0
+        self.parts_queued = 0
+
+    async def _put_part(self, file_part, data):
+        await self.queue.put((file_part, data))
+
+    async def _put_chunk(self, offset, data):
+        for start in range(0, len(data), UPLOAD_PART_SIZE):
+            await self._put_part((offset + start) // UPLOAD_PART_SIZE, data[start:start + UPLOAD_PART_SIZE])
+            self.parts_queued += 1
+
+    async def _download(self):
+        # Upload parts carry their index, so large files can be fetched out of order
+        if self.is_big and use_parallel_download(self.file_size):
+            fetcher = ChunkFetcher(
+                self.client, message_media(self.message), self.file_size,
+                chunk_size=max(Config.DOWNLOAD_CHUNK_KB * 1024, UPLOAD_PART_SIZE)
+            )
+            uploaded = self._uploaded_chunks(fetcher.chunk_size)
+            fetcher.resume(uploaded)
+            self.parts_queued = sum(len(self._chunk_parts(offset, fetcher.chunk_size)) for offset in uploaded)
+            try:
+                await fetcher.run(self._put_chunk)
+                self.downloaded = fetcher.done
+                download_stats["parallel_files"] += 1
+            except CdnRedirect:
+                logging.info("File is served from a CDN, streaming it sequentially")
+                await self._download_sequential()
+        else:
+            await self._download_sequential()
+
+        if self.parts_queued != self.total_parts:
+            raise Exception(f"Stream ended early ({humanbytes(self.downloaded)} of {humanbytes(self.file_size)})")
+
+        await self.queue.put(None)
+
+    def _chunk_parts(self, offset, chunk_size):
+        end = min(offset + chunk_size, self.file_size)
+        return range(offset // UPLOAD_PART_SIZE, math.ceil(end / UPLOAD_PART_SIZE))
+
+    def _uploaded_chunks(self, chunk_size):
+        return {
+            offset for offset in range(0, self.file_size, chunk_size)
+            if all(part in self.uploader.skip for part in self._chunk_parts(offset, chunk_size))
+        }
+
+    async def _download_sequential(self):
+        download_stats["single_files"] += 1
+        self.parts_queued = 0
+        offset = 0
+        pending = b""
+        async for chunk in self.client.stream_media(self.message):
+            self.downloaded += len(chunk)
+            download_stats["bytes"] += len(chunk)
+            pending += chunk
+            while len(pending) >= UPLOAD_PART_SIZE:
+                await self._put_chunk(offset, pending[:UPLOAD_PART_SIZE])
+                pending = pending[UPLOAD_PART_SIZE:]
+                offset += UPLOAD_PART_SIZE
+        if pending:
+            await self._put_chunk(offset, pending)
+
+    async def _parts(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            yield item
+
+    async def run(self):
+        """Run the transfer and return the uploaded InputFile"""
+        download = asyncio.create_task(self._download())
+        upload = asyncio.create_task(self.uploader.upload(self._parts()))
+        await gather_or_cancel(download, upload)
+        return upload.result()
+
+async def send_uploaded_media(client, chat_id, input_file, file_name, upload_type, thumb=None, duration=0, repair=None, width=0, height=0):
+    """Send an already uploaded InputFile as a document or a streamable video.
+
+    `repair(file_part)` re-sends a part Telegram reports missing, when the
+    data is still available to do so.
+    """
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if upload_type == "video":
+        mime_type = client.guess_mime_type(file_name) or "video/mp4"
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            supports_streaming=True,
+            duration=duration or 0,
+            w=width or 0,
+            h=height or 0
+        ))
+    else:
+        mime_type = client.guess_mime_type(file_name) or "application/zip"
+
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=mime_type,
+        file=input_file,
+        force_file=True if upload_type == "document" else None,
+        thumb=await client.save_file(thumb),
+        attributes=attributes
+    )
+
+    with timed("send"):
+        for attempt in range(3):
+            try:
+                r = await client.invoke(
+                    raw.functions.messages.SendMedia(
+                        peer=await client.resolve_peer(chat_id),
+                        media=media,
+                        random_id=client.rnd_id(),
+                        **await utils.parse_text_entities(client, f"`{file_name}`", None, None)
+                    )
+                )
+                break
+            except FilePartMissing as e:
+                if not repair or attempt == 2:
+                    raise
+                logging.warning(f"Upload part {e.value} went missing, sending it again")
+                await repair(e.value)
+
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                client, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+
+async def transfer_file(client, chat_id, original_message, file_size, final_filename, upload_type, duration, thumb_path, progress, checkpoint, width=0, height=0):
+    """Send the original media back to the chat under its new name.
+
+    Partial files and checkpoints are left in place on failure so a retry
+    resumes; the caller discards them once the job is finished. Small files
+    stay in memory while the memory budget allows it.
+    """
+    if use_memory_path(file_size) and memory_budget.reserve(file_size):
+        try:
+            return await transfer_in_memory(
+                client, chat_id, original_message, file_size, final_filename,
+                upload_type, duration, thumb_path, progress, width, height
+            )
+        finally:
+            memory_budget.release(file_size)
+
+    if Config.STREAM_MODE and file_size:
+        progress.set_stage("🔁 **Streaming File**", directions=2)
+        with timed("stream"):
+            input_file = await StreamingUpload(
+                client, original_message, file_size, final_filename,
+                progress=progress_for_pyrogram,
+                progress_args=(progress,),
+                checkpoint=checkpoint
+            ).run()
+        try:
+            return await send_uploaded_media(
+                client, chat_id, input_file, final_filename, upload_type,
+                thumb_path, duration, width=width, height=height
+            )
+        except FilePartMissing:
+            # The streamed data is gone, so the next attempt uploads everything again
+            checkpoint.reset_upload()
+            raise
+
+    # Fallback: download to the job's directory, then upload
+    with timed("storage_wait"):
+        checkpoint.data_path = await storage.reserve(checkpoint.job_id, file_size)
+
+    progress.set_stage("📥 **Downloading File**")
+    with timed("download"):
+        file_path = await download_file(client, original_message, file_size, checkpoint.data_path, progress, checkpoint)
+
+    if not file_path or not os.path.exists(file_path):
+        raise Exception("Download failed")
+
+    progress.set_stage("📤 **Uploading File**")
+    with timed("upload"):
+        input_file, repair = await upload_file(
+            client, file_path, final_filename,
+            progress=progress_for_pyrogram,
+            progress_args=(progress,),
+            checkpoint=checkpoint
+        )
+    return await send_uploaded_media(
+        client, chat_id, input_file, final_filename, upload_type,
+        thumb_path, duration, repair=repair, width=width, height=height
+    )
+
+# ========== MEDIA PROBE ==========
+PROBE_EXTENSIONS = {
+    "mp4", "m4v", "mov", "mkv", "webm", "3gp", "m4a", "mp3", "flac", "wav", "ogg", "oga", "opus"
+}
+MP4_TOP_LEVEL = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pdin"}
+MKV_SEGMENT, MKV_CLUSTER = 0x18538067, 0x1F43B675
+MKV_INFO, MKV_TIMECODE_SCALE, MKV_DURATION = 0x1549A966, 0x2AD7B1, 0x4489
+MKV_TRACKS, MKV_TRACK_ENTRY, MKV_TRACK_TYPE = 0x1654AE6B, 0xAE, 0x83
+MKV_VIDEO, MKV_PIXEL_WIDTH, MKV_PIXEL_HEIGHT = 0xE0, 0xB0, 0xBA
+MP3_BITRATES = {
+    "v1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    "v2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+probe_stats = {"probes": 0, "hits": 0, "found": 0, "bytes": 0}
+
+class ProbeWindow:
+    """The fetched head and tail of a file, addressed by absolute offsets"""
+
+    def __init__(self, head, file_size):
+        self.head = head
+        self.tail = b""
+        self.tail_start = file_size
+        self.file_size = file_size
+        self.missed = False
+
+    def read(self, offset, size):
+        """Return size bytes at offset, or None when they were not fetched"""
+        if offset + size <= len(self.head):
+            return self.head[offset:offset + size]
+        if offset >= self.tail_start and offset + size <= self.tail_start + len(self.tail):
+            return self.tail[offset - self.tail_start:offset - self.tail_start + size]
+        self.missed = True
+        return None
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, body_start, body_end) for the ISO BMFF boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield kind, offset + header, min(offset + size, end)
+        offset += size
+
+def parse_tkhd(data, start):
+    base = start + (52 if data[start] == 1 else 40)
+    if base + 44 > len(data):
+        return 0, 0
+    a, b = struct.unpack_from(">ii", data, base)
+    width, height = (value >> 16 for value in struct.unpack_from(">II", data, base + 36))
+    # A quarter-turn rotation in the matrix swaps the displayed dimensions
+    if a == 0 and abs(b) == 0x10000:
+        width, height = height, width
+    return width, height
+
+def parse_moov(data):
+    info = {}
+    for kind, start, end in iter_boxes(data):
+        if kind == b"mvhd":
+            if data[start] == 1:
+                timescale, duration = struct.unpack_from(">IQ", data, start + 20)
+            else:
+                timescale, duration = struct.unpack_from(">II", data, start + 12)
+            if timescale and duration:
+                info["duration"] = duration / timescale
+        elif kind == b"trak" and "width" not in info:
+            for sub, sub_start, _ in iter_boxes(data, start, end):
+                if sub == b"tkhd":
+                    width, height = parse_tkhd(data, sub_start)
+                    if width and height:
+                        info["width"], info["height"] = width, height
+    return info
+
+def probe_mp4(window):
+    # Walk the top-level boxes; moov sits either before or after the media data
+    offset = 0
+    while offset < window.file_size:
+        header = window.read(offset, min(16, window.file_size - offset))
+        if not header or len(header) < 8:
+            return {}
+        size, kind = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1 and len(header) == 16:
+            size = struct.unpack_from(">Q", header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = window.file_size - offset
+        if size < header_size:
+            return {}
+        if kind == b"moov":
+            moov = window.read(offset + header_size, size - header_size)
+            return parse_moov(moov) if moov else {}
+        offset += size
+    return {}
+
+def read_vint(data, offset, keep_marker):
+    """Read an EBML variable-length integer, returns (value, length, unknown_size)"""
+    first = data[offset]
+    length, mask = 1, 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8 or offset + length > len(data):
+        raise ValueError("Truncated EBML integer")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[offset + 1:offset + length]:
+        value = (value << 8) | byte
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, length, unknown
+
+def iter_ebml(data, start, end):
+    """Yield (id, body_start, body_end) for the EBML elements in data[start:end]"""
+    offset = start
+    while offset < end:
+        try:
+            element_id, id_length, _ = read_vint(data, offset, True)
+            size, size_length, unknown = read_vint(data, offset + id_length, False)
+        except (ValueError, IndexError):
+            return
+        body = offset + id_length + size_length
+        yield element_id, body, end if unknown else min(body + size, end)
+        if unknown:
+            return
+        offset = body + size
+
+def probe_matroska(data):
+    info = {}
+    scale = 1000000
+    duration = None
+    for element_id, start, end in iter_ebml(data, 0, len(data)):
+        if element_id != MKV_SEGMENT:
+            continue
+        for child_id, child_start, child_end in iter_ebml(data, start, end):
+            if child_id == MKV_CLUSTER:
+                break
+            if child_id == MKV_INFO:
+                for field, s, e in iter_ebml(data, child_start, child_end):
+                    if field == MKV_TIMECODE_SCALE:
+                        scale = int.from_bytes(data[s:e], "big")
+                    elif field == MKV_DURATION and e - s in (4, 8):
+                        duration = struct.unpack(">f" if e - s == 4 else ">d", data[s:e])[0]
+            elif child_id == MKV_TRACKS:
+                for entry, s, e in iter_ebml(data, child_start, child_end):
+                    if entry == MKV_TRACK_ENTRY and "width" not in info:
+                        info.update(parse_matroska_track(data, s, e))
+        break
+    if duration:
+        info["duration"] = duration * scale / 1e9
+    return info
+
+def parse_matroska_track(data, start, end):
+    track_type = None
+    size = {}
+    for field, s, e in iter_ebml(data, start, end):
+        if field == MKV_TRACK_TYPE:
+            track_type = int.from_bytes(data[s:e], "big")
+        elif field == MKV_VIDEO:
+            for video_field, vs, ve in iter_ebml(data, s, e):
+                if video_field == MKV_PIXEL_WIDTH:
+                    size["width"] = int.from_bytes(data[vs:ve], "big")
+                elif video_field == MKV_PIXEL_HEIGHT:
+                    size["height"] = int.from_bytes(data[vs:ve], "big")
+    return size if track_type == 1 and len(size) == 2 else {}
+
+def probe_mp3(window):
+    data = window.head
+    offset = 0
+    if data[:3] == b"ID3":
+        offset = 10 + (data[6] << 21 | data[7] << 14 | data[8] << 7 | data[9])
+        if data[5] & 0x10:
+            offset += 10
+    while offset + 4 <= len(data) and not (data[offset] == 0xFF and data[offset + 1] & 0xE0 == 0xE0):
+        offset += 1
+    if offset + 4 > len(data):
+        return {}
+
+    header = struct.unpack_from(">I", data, offset)[0]
+    version = (header >> 19) & 3
+    layer = (header >> 17) & 3
+    bitrate_index = (header >> 12) & 0xF
+    rate_index = (header >> 10) & 3
+    mono = (header >> 6) & 3 == 3
+    if layer != 1 or version == 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return {}
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    samples_per_frame = 1152 if version == 3 else 576
+
+    # VBR files announce their frame count in a Xing/Info or VBRI header
+    side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info") and struct.unpack_from(">I", data, xing + 4)[0] & 1:
+        frames = struct.unpack_from(">I", data, xing + 8)[0]
+        return {"duration": frames * samples_per_frame / sample_rate}
+    vbri = offset + 36
+    if data[vbri:vbri + 4] == b"VBRI":
+        frames = struct.unpack_from(">I", data, vbri + 14)[0]
+        return {"duration": frames * samples_per_frame / sample_rate}
+
+    bitrate = MP3_BITRATES["v1" if version == 3 else "v2"][bitrate_index] * 1000
+    return {"duration": (window.file_size - offset) * 8 / bitrate}
+
+def probe_flac(data):
+    # STREAMINFO is always the first metadata block
+    if len(data) < 26:
+        return {}
+    fields = int.from_bytes(data[18:26], "big")
+    sample_rate = fields >> 44
+    total_samples = fields & ((1 << 36) - 1)
+    return {"duration": total_samples / sample_rate} if sample_rate and total_samples else {}
+
+def probe_wav(window):
+    data = window.head
+    offset = 12
+    byte_rate = None
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, offset)
+        if chunk_id == b"fmt " and offset + 20 <= len(data):
+            byte_rate = struct.unpack_from("<I", data, offset + 16)[0]
+        elif chunk_id == b"data":
+            size = min(size, window.file_size - offset - 8)
+            return {"duration": size / byte_rate} if byte_rate else {}
+        offset += 8 + size + (size & 1)
+    return {}
+
+def probe_ogg(window):
+    data = window.head
+    packet = data[27 + data[26]:]
+    if packet[:7] == b"\x01vorbis":
+        sample_rate = struct.unpack_from("<I", packet, 12)[0]
+        pre_skip = 0
+    elif packet[:8] == b"OpusHead":
+        sample_rate = 48000
+        pre_skip = struct.unpack_from("<H", packet, 10)[0]
+    else:
+        return {}
+
+    # The granule position of the last page is the stream length in samples
+    tail = window.tail if window.tail else data if len(data) >= window.file_size else None
+    if tail is None:
+        window.missed = True
+        return {}
+    page = tail.rfind(b"OggS")
+    while page >= 0:
+        if page + 14 <= len(tail):
+            granule = struct.unpack_from("<q", tail, page + 6)[0]
+            if granule > 0:
+                return {"duration": max(granule - pre_skip, 0) / sample_rate}
+        page = tail.rfind(b"OggS", 0, page)
+    return {}
+
+def parse_media_headers(window):
+    """Return whatever duration, width and height the headers give away"""
+    head = window.head
+    if head[4:8] in MP4_TOP_LEVEL:
+        return probe_mp4(window)
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return probe_matroska(head)
+    if head[:4] == b"fLaC":
+        return probe_flac(head)
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return probe_wav(window)
+    if head[:4] == b"OggS":
+        return probe_ogg(window)
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return probe_mp3(window)
+    return {}
+
+class MediaProbe:
+    """Duration and dimensions read from a file's headers.
+
+    Only the first chunk is fetched, plus the last few when the index sits at
+    the end of the file (MP4 with moov last, Ogg). Results are cached by
+    file_unique_id, including files that turned out not to be parseable.
+    """
+
+    def __init__(self, max_entries, tail_chunks):
+        self.max_entries = max_entries
+        self.tail_chunks = tail_chunks
+        self.cache = OrderedDict()
+
+    def wanted(self, session, upload_type):
+        file_name = session.file_name or ""
+        extension = file_name.rsplit(".", 1)[-1].lower() if "." in file_name else ""
+        known = session.duration and session.width and session.height
+        return Config.PROBE_MEDIA and session.file_size and (
+            (upload_type == "video" and not known) or (not session.duration and extension in PROBE_EXTENSIONS)
+        )
+
+    async def _fetch(self, client, message, chunk, count):
+        data = bytearray()
+        async for piece in client.stream_media(message, offset=chunk, limit=count):
+            data += piece
+        probe_stats["bytes"] += len(data)
+        return bytes(data)
+
+    def _parse(self, window):
+        try:
+            return parse_media_headers(window)
+        except (struct.error, IndexError, ValueError, ZeroDivisionError) as e:
+            logging.warning(f"Could not parse media headers: {e}")
+            return {}
+
+    async def probe(self, client, message, file_unique_id, file_size):
+        if file_unique_id in self.cache:
+            self.cache.move_to_end(file_unique_id)
+            probe_stats["hits"] += 1
+            return self.cache[file_unique_id]
+
+        probe_stats["probes"] += 1
+        window = ProbeWindow(await self._fetch(client, message, 0, 1), file_size)
+        info = self._parse(window)
+        chunks = math.ceil(file_size / MB)
+        if window.missed and chunks > 1:
+            first = max(1, chunks - self.tail_chunks)
+            window.tail = await self._fetch(client, message, first, chunks - first)
+            window.tail_start = first * MB
+            info = self._parse(window)
+
+        if info:
+            probe_stats["found"] += 1
+        self.cache[file_unique_id] = info
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return info
+
+    async def for_job(self, client, message, session, upload_type):
+        """Probe a job's file when its upload needs it; never fails the job"""
+        if not self.wanted(session, upload_type):
+            return {}
+        try:
+            return await self.probe(client, message, session.file_unique_id, session.file_size)
+        except Exception as e:
+            logging.warning(f"Media probe failed: {e}")
+            return {}
+
+media_probe = MediaProbe(Config.PROBE_CACHE_SIZE, Config.PROBE_TAIL_CHUNKS)
+
+# ========== JOB SCHEDULER ==========
+class QueueFull(Exception):
+    """Raised when the scheduler sheds a job instead of queueing it"""
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+class Lane:
+    """Jobs of one size class: its own queues, slot limit and reserved slots"""
+
+    def __init__(self, name, max_size, slots, reserved):
+        self.name = name
+        self.max_size = max_size  # None means no upper bound
+        self.slots = slots
+        self.reserved = reserved
+        self.queues = {}  # user_id -> deque of waiting jobs
+        self.order = deque()  # users with waiting jobs, in round-robin order
+        self.running = 0
+        self.wait_times = deque(maxlen=1000)
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def unmet_reservation(self):
+        return max(0, self.reserved - self.running)
+
+    def push(self, job):
+        if job.user_id not in self.queues:
+            self.queues[job.user_id] = deque()
+            self.order.append(job.user_id)
+        self.queues[job.user_id].append(job)
+
+    def remove(self, job):
+        """Take a waiting job out of the lane, False if it is not waiting"""
+        queue = self.queues.get(job.user_id)
+        if not queue or job not in queue:
+            return False
+        queue.remove(job)
+        if not queue:
+            del self.queues[job.user_id]
+            self.order.remove(job.user_id)
+        return True
+
+    def pop(self, user_running, max_per_user, admit):
+        """Next job in round-robin order whose user is under their limit and that admit() lets in"""
+        for _ in range(len(self.order)):
+            user_id = self.order[0]
+            self.order.rotate(-1)
+            if user_running.get(user_id, 0) < max_per_user and admit(self.queues[user_id][0]):
+                break
+        else:
+            return None  # Every waiting user is at their own limit or held back
+
+        queue = self.queues[user_id]
+        job = queue.popleft()
+        if not queue:
+            del self.queues[user_id]
+            self.order.remove(user_id)
+        return job
+
+    def position(self, job):
+        """1-based place of a waiting job in this lane, 0 if not waiting"""
+        queue = self.queues.get(job.user_id)
+        if not queue or job not in queue:
+            return 0
+        index = queue.index(job)
+        position = index + 1
+        ahead = True
+        for user_id in self.order:
+            if user_id == job.user_id:
+                ahead = False
+                continue
+            waiting = len(self.queues[user_id])
+            position += min(waiting, index)
+            if ahead and waiting > index:
+                position += 1
+        return position
+
+class JobScheduler:
+    """Run jobs under global, per-lane and per-user concurrency limits.
+
+    Jobs are sorted into lanes by file size. Each lane has its own slot limit
+    and may reserve part of the global capacity, so a burst of large files
+    can never take the slots small files rely on. Inside a lane waiting jobs
+    sit in one FIFO per user and users are served round-robin.
+    Jobs are any object with ``user_id``, ``file_size``, an async ``run()``,
+    an optional async ``notify_position(position)`` and an optional
+    ``admit()`` that keeps the job queued while it returns False.
+    """
+
+    def __init__(self, max_running, max_per_user, max_queued, max_queued_per_user, lanes, notify_interval=5):
+        if sum(lane.reserved for lane in lanes) > max_running:
+            raise ValueError("Lane reservations exceed the global job limit")
+        self.max_running = max_running
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.notify_interval = notify_interval
+        self.lanes = sorted(lanes, key=lambda lane: float("inf") if lane.max_size is None else lane.max_size)
+        self.running = {}  # user_id -> running job count
+        self.active = {}  # id(job) -> running job
+        self.total_running = 0
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "cancelled": 0}
+        self._notifier = None
+
+    def lane_for(self, file_size):
+        for lane in self.lanes:
+            if lane.max_size is None or file_size <= lane.max_size:
+                return lane
+        return self.lanes[-1]
+
+    def queue_depth(self):
+        return sum(lane.depth() for lane in self.lanes)
+
+    def user_jobs(self, user_id):
+        """Queued plus running jobs for one user"""
+        queued = sum(len(lane.queues.get(user_id, ())) for lane in self.lanes)
+        return queued + self.running.get(user_id, 0)
+
+    def take_waiting(self):
+        """Empty every lane, returning the jobs that were waiting"""
+        jobs = []
+        for lane in self.lanes:
+            for queue in lane.queues.values():
+                jobs.extend(queue)
+            lane.queues.clear()
+            lane.order.clear()
+        return jobs
+
+    def user_active(self, user_id):
+        """One user's running and waiting jobs"""
+        running = [job for job in self.active.values() if job.user_id == user_id]
+        return running + [job for lane in self.lanes for job in lane.queues.get(user_id, ())]
+
+    def cancel(self, job):
+        """Drop a waiting job, or cancel a running one's task; its slot frees when the task ends"""
+        if job.lane.remove(job):
+            self.counters["cancelled"] += 1
+            return
+        if job.task:
+            job.task.cancel()
+
+    def check_capacity(self, user_id):
+        """Raise QueueFull if a new job from this user would be shed"""
+        if self.queue_depth() >= self.max_queued:
+            raise QueueFull("Bot is busy right now, please try again in a few minutes.")
+        if self.user_jobs(user_id) >= self.max_queued_per_user:
+            raise QueueFull(f"You already have {self.user_jobs(user_id)} files in progress, wait for them to finish.")
+
+    def submit(self, job, force=False):
+        """Queue a job and return its position in its lane (0 if it started right away).
+
+        force skips the queue limits, for the files of a batch that was
+        checked as a whole.
+        """
+        try:
+            if not force:
+                self.check_capacity(job.user_id)
+        except QueueFull:
+            self.counters["rejected"] += 1
+            raise
+
+        self.counters["submitted"] += 1
+        job.queued_at = time.monotonic()
+        job.last_position = None
+        job.task = None
+        job.lane = self.lane_for(job.file_size)
+        job.lane.push(job)
+
+        self._dispatch()
+        position = job.lane.position(job)
+        if position and self._notifier is None:
+            self._notifier = asyncio.create_task(self._notify_positions())
+        return position
+
+    def _lane_has_slot(self, lane):
+        if lane.running >= lane.slots:
+            return False
+        held_back = sum(other.unmet_reservation() for other in self.lanes if other is not lane)
+        return self.max_running - self.total_running - held_back > 0
+
+    def _dispatch(self):
+        started = True
+        while started and self.total_running < self.max_running:
+            started = False
+            for lane in self.lanes:
+                if lane.order and self._lane_has_slot(lane):
+                    job = lane.pop(self.running, self.max_per_user, self._admit)
+                    if job:
+                        self._start(job)
+                        started = True
+
+    @staticmethod
+    def _admit(job):
+        admit = getattr(job, "admit", None)
+        return admit is None or admit()
+
+    def _start(self, job):
+        self.running[job.user_id] = self.running.get(job.user_id, 0) + 1
+        self.total_running += 1
+        job.lane.running += 1
+        job.lane.wait_times.append(time.monotonic() - job.queued_at)
+        stage_latency.observe("queue", job.lane.wait_times[-1])
+        self.active[id(job)] = job
+        job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        trace_job.set(job.job_id)
+        token = getattr(job, "token", None)
+        try:
+            status = await job.run()
+            self.counters["failed" if status == "failed" else "completed"] += 1
+        except JobCancelled:
+            self.counters["cancelled"] += 1
+        except asyncio.CancelledError:
+            # Cancelled by its user: the task ends normally. Anything else (shutdown) propagates
+            if not (token and token.cancelled):
+                raise
+            self.counters["cancelled"] += 1
+        except Exception as e:
+            self.counters["failed"] += 1
+            logging.error(f"Job failed: {e}")
+        finally:
+            del self.active[id(job)]
+            self.running[job.user_id] -= 1
+            if not self.running[job.user_id]:
+                del self.running[job.user_id]
+            self.total_running -= 1
+            job.lane.running -= 1
+            self._dispatch()
+
+    async def _notify_positions(self):
+        """Periodically tell waiting users where they are in the queue"""
+        try:
+            while self.queue_depth():
+                # Jobs held back by admit() may fit now without any job having ended
+                self._dispatch()
+                for lane in self.lanes:
+                    for queue in list(lane.queues.values()):
+                        for job in list(queue):
+                            position = lane.position(job)
+                            if position != job.last_position and hasattr(job, "notify_position"):
+                                job.last_position = position
+                                asyncio.create_task(job.notify_position(position))
+                await asyncio.sleep(self.notify_interval)
+        finally:
+            self._notifier = None
+
+    def stats(self):
+        now = time.monotonic()
+        lanes = {}
+        for lane in self.lanes:
+            waits = list(lane.wait_times)
+            oldest = min((queue[0].queued_at for queue in lane.queues.values()), default=None)
+            lanes[lane.name] = {
+                "running": lane.running,
+                "slots": lane.slots,
+                "reserved": lane.reserved,
+                "queued": lane.depth(),
+                "wait_p50": percentile(waits, 50),
+                "wait_p95": percentile(waits, 95),
+                "wait_p99": percentile(waits, 99),
+                "oldest_wait": now - oldest if oldest is not None else 0,
+            }
+        waits = [wait for lane in self.lanes for wait in lane.wait_times]
+        return {
+            **self.counters,
+            "running": self.total_running,
+            "queued": self.queue_depth(),
+            "waiting_users": len({user_id for lane in self.lanes for user_id in lane.order}),
+            "wait_p50": percentile(waits, 50),
+            "wait_p95": percentile(waits, 95),
+            "wait_max": max(waits, default=0),
+            "oldest_wait": max((lane["oldest_wait"] for lane in lanes.values()), default=0),
+            "lanes": lanes,
+        }
+
+scheduler = JobScheduler(
+    Config.MAX_CONCURRENT_JOBS,
+    Config.MAX_JOBS_PER_USER,
+    Config.MAX_QUEUED_JOBS,
+    Config.MAX_QUEUED_PER_USER,
+    lanes=[
+        Lane("small", Config.LANE_SMALL_MAX_MB * MB, Config.LANE_SMALL_SLOTS, Config.LANE_SMALL_RESERVED),
+        Lane("medium", Config.LANE_MEDIUM_MAX_MB * MB, Config.LANE_MEDIUM_SLOTS, Config.LANE_MEDIUM_RESERVED),
+        Lane("large", None, Config.LANE_LARGE_SLOTS, Config.LANE_LARGE_RESERVED),
+    ]
+)
+
+# ========== OUTBOUND RATE LIMITER ==========
+PRIORITY_REPLY = 0  # Messages and files the user is waiting for
+PRIORITY_ACTION = 1  # Housekeeping such as deleting prompts
+PRIORITY_PROGRESS = 2  # Progress and queue position edits
+PRIORITY_NAMES = {PRIORITY_REPLY: "reply", PRIORITY_ACTION: "action", PRIORITY_PROGRESS: "progress"}
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.parked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        """Earliest time a token can be taken"""
+        self._refill(now)
+        ready = now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+        return max(ready, self.parked_until)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def park(self, seconds):
+        self.parked_until = max(self.parked_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst and self.parked_until <= now
+
+class OutboundLimiter:
+    """Shape every outgoing chat API call through global and per-chat token buckets.
+
+    Calls wait in one FIFO per priority class and are released highest
+    priority first, as soon as both their chat's bucket and the global bucket
+    have a token. A FloodWait parks the bucket it hit for the requested time
+    and the call is queued again instead of failing the job.
+    """
+
+    def __init__(self, global_rate, global_burst, chat_rate, chat_burst, max_flood_retries=5):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_flood_retries = max_flood_retries
+        self.chat_buckets = {}
+        self.queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self.wait_times = {priority: deque(maxlen=1000) for priority in PRIORITY_NAMES}
+        self.counters = {"calls": 0, "flood_waits": 0, "flood_seconds": 0}
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+
+    def _bucket(self, chat_key):
+        if chat_key is None:
+            return None
+        if chat_key not in self.chat_buckets:
+            if len(self.chat_buckets) > 10000:
+                now = time.monotonic()
+                for key in [key for key, bucket in self.chat_buckets.items() if bucket.idle(now)]:
+                    del self.chat_buckets[key]
+            self.chat_buckets[chat_key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[chat_key]
+
+    async def call(self, chat_key, priority, func, *args, retry_flood=True, **kwargs):
+        """Run ``func(*args, **kwargs)`` once the buckets allow it"""
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self._dispatch())
+
+        for attempt in range(self.max_flood_retries + 1):
+            future = asyncio.get_running_loop().create_future()
+            self.queues[priority].append((chat_key, future, time.monotonic()))
+            self.wakeup.set()
+            await future
+
+            try:
+                return await func(*args, **kwargs)
+            except FloodWait as e:
+                self.counters["flood_waits"] += 1
+                self.counters["flood_seconds"] += e.value
+                bucket = self._bucket(chat_key) or self.global_bucket
+                bucket.park(e.value)
+                logging.warning(f"FloodWait of {e.value}s for chat {chat_key}, parking its bucket")
+                if not retry_flood or attempt == self.max_flood_retries:
+                    raise
+
+    async def _dispatch(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            next_ready = None
+
+            for priority, queue in self.queues.items():
+                blocked = set()
+                for item in list(queue):
+                    chat_key, future, queued_at = item
+                    if future.done():
+                        queue.remove(item)
+                        continue
+                    if chat_key in blocked:
+                        continue
+
+                    bucket = self._bucket(chat_key)
+                    ready = max(self.global_bucket.ready_at(now), bucket.ready_at(now) if bucket else now)
+                    if ready > now:
+                        blocked.add(chat_key)
+                        next_ready = ready if next_ready is None else min(next_ready, ready)
+                        continue
+
+                    self.global_bucket.take(now)
+                    if bucket:
+                        bucket.take(now)
+                    queue.remove(item)
+                    self.counters["calls"] += 1
+                    self.wait_times[priority].append(now - queued_at)
+                    future.set_result(None)
+
+            timeout = None if next_ready is None else max(0.01, next_ready - time.monotonic())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            **self.counters,
+            "queued": {PRIORITY_NAMES[p]: len(q) for p, q in self.queues.items()},
+            "parked_chats": sum(1 for b in self.chat_buckets.values() if b.parked_until > time.monotonic()),
+            "wait_p50": {PRIORITY_NAMES[p]: percentile(list(w), 50) for p, w in self.wait_times.items()},
+            "wait_p95": {PRIORITY_NAMES[p]: percentile(list(w), 95) for p, w in self.wait_times.items()},
+        }
+
+outbound = OutboundLimiter(
+    Config.OUTBOUND_GLOBAL_RATE,
+    Config.OUTBOUND_GLOBAL_BURST,
+    Config.OUTBOUND_CHAT_RATE,
+    Config.OUTBOUND_CHAT_BURST
+)
+
+# Chat-visible API calls and the priority class they are shaped with
+OUTBOUND_PRIORITIES = {
+    raw.functions.messages.SendMessage: PRIORITY_REPLY,
+    raw.functions.messages.SendMedia: PRIORITY_REPLY,
+    raw.functions.messages.SetBotCallbackAnswer: PRIORITY_REPLY,
+    raw.functions.messages.DeleteMessages: PRIORITY_ACTION,
+    raw.functions.messages.EditMessage: PRIORITY_PROGRESS,
+}
+
+def outbound_chat_key(query):
+    peer = getattr(query, "peer", None)
+    if peer is None:
+        return None
+    return getattr(peer, "user_id", None) or getattr(peer, "chat_id", None) or getattr(peer, "channel_id", None)
+
+# ========== DATABASE CLASS ==========
+class UserProfile:
+    """Everything a job needs to know about a user, loaded in one query"""
+    __slots__ = ("user_id", "thumbnail")
+
+    # Mongo field for each profile attribute
+    FIELDS = {"thumbnail": "file_id"}
+
+    def __init__(self, user_id, thumbnail=None):
+        self.user_id = user_id
+        self.thumbnail = thumbnail
+
+    @classmethod
+    def from_doc(cls, user_id, doc):
+        doc = doc or {}
+        return cls(user_id, **{attr: doc.get(field) for attr, field in cls.FIELDS.items()})
+
+class Database:
+    def __init__(self, uri, database_name):
+        self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+        self.db = self._client[database_name]
+        self.col = self.db.users
+        # Read-through profile cache: user_id -> (expires_at, UserProfile)
+        self.profiles = OrderedDict()
+        self.loading = {}  # user_id -> profile fetch in progress
+        self.pending_writes = []  # (UpdateOne, future) waiting for the next bulk_write
+        self.flush_task = None
+        self.watch_task = None
+        self.epoch = 0  # bumped on every invalidation so in-flight loads don't cache stale data
+        self.counters = {"hits": 0, "misses": 0, "bulk_writes": 0, "writes": 0, "invalidations": 0}
+
+    async def ping(self):
+        """Round-trip to the server, for health checks"""
+        await self._client.admin.command("ping")
+
+    async def _load_profile(self, user_id):
+        doc = await self.col.find_one(
+            {"_id": user_id},
+            projection={field: 1 for field in UserProfile.FIELDS.values()}
+        )
+        return UserProfile.from_doc(user_id, doc)
+
+    async def get_profile(self, user_id):
+        self._start_watch()
+        entry = self.profiles.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self.profiles.move_to_end(user_id)
+            self.counters["hits"] += 1
+            return entry[1]
+
+        self.counters["misses"] += 1
+        epoch = self.epoch
+        if user_id not in self.loading:
+            self.loading[user_id] = asyncio.ensure_future(self._load_profile(user_id))
+        try:
+            profile = await asyncio.shield(self.loading[user_id])
+        finally:
+            self.loading.pop(user_id, None)
+
+        if epoch != self.epoch:
+            return profile
+        self.profiles[user_id] = (time.monotonic() + Config.PROFILE_CACHE_TTL, profile)
+        self.profiles.move_to_end(user_id)
+        while len(self.profiles) > Config.PROFILE_CACHE_SIZE:
+            self.profiles.popitem(last=False)
+        return profile
+
+    def invalidate(self, user_id):
+        self.epoch += 1
+        self.loading.pop(user_id, None)
+        if self.profiles.pop(user_id, None):
+            self.counters["invalidations"] += 1
+
+    async def update_profile(self, user_id, **changes):
+        """Write profile fields through to Mongo, batched with other users' writes"""
+        update = {"$set": {UserProfile.FIELDS[attr]: value for attr, value in changes.items()}}
+        future = asyncio.get_running_loop().create_future()
+        self.pending_writes.append((UpdateOne({"_id": user_id}, update, upsert=True), future))
+        if len(self.pending_writes) >= Config.PROFILE_WRITE_BATCH:
+            await self._flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+        try:
+            await future
+        finally:
+            self.invalidate(user_id)
+
+    async def _flush_later(self):
+        await asyncio.sleep(Config.PROFILE_WRITE_WINDOW)
+        self.flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        batch, self.pending_writes = self.pending_writes, []
+        if not batch:
+            return
+        try:
+            await self.col.bulk_write([op for op, _ in batch], ordered=True)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            self.counters["bulk_writes"] += 1
+            self.counters["writes"] += len(batch)
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def _start_watch(self):
+        if Config.PROFILE_CHANGE_STREAM and self.watch_task is None:
+            self.watch_task = asyncio.create_task(self._watch_profiles())
+
+    async def _watch_profiles(self):
+        """Drop cached profiles that another bot process changed"""
+        while True:
+            try:
+                async with self.col.watch() as stream:
+                    async for change in stream:
+                        user_id = change.get("documentKey", {}).get("_id")
+                        if user_id is not None:
+                            self.invalidate(user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Profile change stream interrupted: {e}")
+                # Anything may have changed while we were not listening
+                self.epoch += 1
+                self.profiles.clear()
+                await asyncio.sleep(5)
+
+    async def set_thumbnail(self, user_id, file_id):
+        await self.update_profile(user_id, thumbnail=file_id)
+
+    async def get_thumbnail(self, user_id):
+        return (await self.get_profile(user_id)).thumbnail
+
+# Initialize database
+db = Database(Config.DB_URL, Config.DB_NAME)
+
+# ========== RESULT CACHE ==========
+class ResultCache:
+    """Remember what each rename produced so repeats can be re-sent by file_id.
+
+    Entries are keyed on everything that shapes the uploaded message and
+    expire after RESULT_CACHE_TTL_DAYS without a hit.
+    """
+
+    def __init__(self, collection, ttl_days):
+        self.col = collection
+        self.ttl = ttl_days * 24 * 3600
+        self.counters = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+        self._indexed = False
+
+    @staticmethod
+    def key(file_unique_id, final_filename, upload_type, thumbnail_id, duration):
+        raw_key = "|".join(str(part) for part in (file_unique_id, final_filename, upload_type, thumbnail_id, duration))
+        return sha256(raw_key.encode()).hexdigest()
+
+    async def _ensure_index(self):
+        if not self._indexed:
+            await self.col.create_index("last_used", expireAfterSeconds=self.ttl)
+            self._indexed = True
+
+    async def warm(self):
+        """Create the index at startup instead of on the first lookup"""
+        await self._ensure_index()
+
+    async def get(self, key):
+        await self._ensure_index()
+        entry = await self.col.find_one_and_update(
+            {"_id": key},
+            {"$set": {"last_used": datetime.utcnow()}, "$inc": {"hits": 1}},
+            projection={"file_id": 1}
+        )
+        if entry:
+            self.counters["hits"] += 1
+            return entry["file_id"]
+        self.counters["misses"] += 1
+        return None
+
+    async def put(self, key, file_id, final_filename):
+        await self._ensure_index()
+        await self.col.update_one(
+            {"_id": key},
+            {"$set": {"file_id": file_id, "file_name": final_filename, "last_used": datetime.utcnow()}},
+            upsert=True
+        )
+        self.counters["stored"] += 1
+
+    async def invalidate(self, key):
+        await self.col.delete_one({"_id": key})
+        self.counters["invalidated"] += 1
+
+    def hit_rate(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return self.counters["hits"] / lookups if lookups else 0
+
+result_cache = ResultCache(db.db.results, Config.RESULT_CACHE_TTL_DAYS)
+
+# ========== THUMBNAIL CACHE ==========
+class ThumbnailCache:
+    """On-disk copies of user thumbnails keyed by file_id, evicted LRU by total size.
+
+    Thumbnails are normalized by process_thumb_async when they enter the
+    cache, so jobs only ever read ready-made JPEG bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # file name -> size, oldest first
+        self.total_bytes = 0
+        self.pins = {}  # file name -> jobs currently using it
+        self.dropped = set()  # pinned names to delete once their last job releases them
+        self.fetching = {}  # file name -> download in progress
+        self.counters = {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_trimmed": 0, "evictions": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        existing = [entry for entry in os.scandir(directory) if entry.is_file()]
+        for entry in sorted(existing, key=lambda e: e.stat().st_mtime):
+            self.entries[entry.name] = entry.stat().st_size
+            self.total_bytes += entry.stat().st_size
+
+    @staticmethod
+    def _name(file_id):
+        return sha256(file_id.encode()).hexdigest()[:32] + ".jpg"
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    async def _fetch(self, client, file_id, name):
+        data = await client.download_media(file_id, in_memory=True)
+        if data is None:
+            raise Exception("Thumbnail download failed")
+        original = data.getbuffer().nbytes
+        data = await process_thumb_async(bytes(data.getbuffer()))
+        self.counters["bytes_trimmed"] += original - len(data)
+        with open(self._path(name), "wb") as f:
+            f.write(data)
+        self.entries[name] = len(data)
+        self.total_bytes += len(data)
+        self._evict()
+
+    def _evict(self):
+        for name in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if self.pins.get(name):
+                continue
+            self._remove(name)
+            self.counters["evictions"] += 1
+
+    def _remove(self, name):
+        self.dropped.discard(name)
+        if name in self.entries:
+            self.total_bytes -= self.entries.pop(name)
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    async def put(self, client, file_id):
+        """Download a thumbnail into the cache unless it is already there"""
+        name = self._name(file_id)
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            return self._path(name)
+        if name not in self.fetching:
+            self.fetching[name] = asyncio.ensure_future(self._fetch(client, file_id, name))
+        try:
+            await asyncio.shield(self.fetching[name])
+        finally:
+            self.fetching.pop(name, None)
+        return self._path(name)
+
+    async def acquire(self, client, file_id):
+        """Path to a cached thumbnail, pinned against eviction until release()"""
+        name = self._name(file_id)
+        if name in self.entries and os.path.exists(self._path(name)):
+            self.counters["hits"] += 1
+            self.counters["bytes_saved"] += self.entries[name]
+        else:
+            self.counters["misses"] += 1
+            if name in self.entries:
+                self.total_bytes -= self.entries.pop(name)
+        self.dropped.discard(name)
+        self.pins[name] = self.pins.get(name, 0) + 1
+        try:
+            return await self.put(client, file_id)
+        except BaseException:
+            self.release(file_id)
+            raise
+
+    def release(self, file_id):
+        name = self._name(file_id)
+        if self.pins.get(name, 0) > 1:
+            self.pins[name] -= 1
+        else:
+            self.pins.pop(name, None)
+            if name in self.dropped:
+                self._remove(name)
+        self._evict()
+
+    def drop(self, file_id):
+        """Forget a thumbnail; a job still sending it keeps the file until it releases it"""
+        name = self._name(file_id)
+        if self.pins.get(name):
+            self.dropped.add(name)
+        elif name in self.entries:
+            self._remove(name)
+
+    def hit_rate(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return self.counters["hits"] / lookups if lookups else 0
+
+thumb_cache = ThumbnailCache(Config.THUMB_CACHE_DIR, Config.THUMB_CACHE_MAX_MB * 1024 * 1024)
+
+# ========== SESSION STATE ==========
+class RenameSession:
+    """Where one user is in the rename dialog.
+
+    Only ids and plain values are kept; the original message is fetched
+    again by id when its transfer starts.
+    """
+    __slots__ = (
+        "user_id", "chat_id", "message_id", "file_id", "file_unique_id", "file_name",
+        "file_size", "file_type", "duration", "step", "new_filename", "ask_message_id", "updated_at",
+        "batch", "prompt_message_id", "width", "height"
+    )
+    BATCH_ITEM_FIELDS = (
+        "message_id", "file_id", "file_unique_id", "file_name", "file_size", "file_type", "duration", "width", "height"
+    )
+
+    def __init__(self, user_id, chat_id, message_id, file_id, file_unique_id, file_name, file_size,
+                 file_type, duration, step="awaiting_rename", new_filename=None, ask_message_id=None,
+                 updated_at=None, batch=None, prompt_message_id=None, width=0, height=0):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_type = file_type
+        self.duration = duration
+        self.step = step
+        self.new_filename = new_filename
+        self.ask_message_id = ask_message_id
+        self.updated_at = updated_at or time.time()
+        self.batch = batch  # further files of a batch, as dicts of BATCH_ITEM_FIELDS
+        self.prompt_message_id = prompt_message_id
+        self.width = width or 0  # known for Telegram videos, probed for the rest
+        self.height = height or 0
+
+    def state(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def to_doc(self):
+        doc = self.state()
+        doc["_id"] = doc.pop("user_id")
+        doc["updated_at"] = datetime.utcfromtimestamp(self.updated_at)
+        return doc
+
+    @classmethod
+    def from_doc(cls, doc):
+        doc = dict(doc)
+        doc["user_id"] = doc.pop("_id")
+        doc["updated_at"] = doc["updated_at"].replace(tzinfo=timezone.utc).timestamp()
+        return cls(**{slot: doc.get(slot) for slot in cls.__slots__})
+
+    def files(self):
+        """One single-file session per file of a batch, in the order they were sent"""
+        first = RenameSession(**{field: getattr(self, field) for field in ("user_id", "chat_id") + self.BATCH_ITEM_FIELDS})
+        rest = [RenameSession(self.user_id, self.chat_id, **item) for item in self.batch or []]
+        return sorted([first] + rest, key=lambda session: session.message_id)
+
+    async def fetch_message(self, client):
+        """Re-fetch the message holding the original file"""
+        message = await client.get_messages(self.chat_id, self.message_id)
+        if not message or message.empty:
+            raise Exception("The original file message was deleted")
+        return message
+
+class SessionStore:
+    """Rename sessions by user id, expired after SESSION_TTL seconds idle.
+
+    With SESSION_PERSIST every change is mirrored to Mongo and the sessions
+    are loaded back on first use, so a redeploy doesn't drop open dialogs.
+    """
+
+    def __init__(self, collection, ttl, max_sessions, persist):
+        self.col = collection
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.persist = persist
+        self.sessions = OrderedDict()  # user_id -> RenameSession, least recently touched first
+        self._loaded = not persist
+        self._load_lock = asyncio.Lock()
+
+    async def _load(self):
+        async with self._load_lock:
+            if self._loaded:
+                return
+            await self.col.create_index("updated_at", expireAfterSeconds=self.ttl)
+            async for doc in self.col.find({}):
+                session = RenameSession.from_doc(doc)
+                self.sessions[session.user_id] = session
+            self._loaded = True
+            self.sweep()
+            logging.info(f"Restored {len(self.sessions)} rename sessions")
+
+    async def warm(self):
+        """Restore persisted sessions at startup instead of on the first message"""
+        await self._load()
+
+    def sweep(self):
+        """Drop expired sessions, and the oldest ones past the size limit"""
+        cutoff = time.time() - self.ttl
+        expired = []
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if session.updated_at >= cutoff and len(self.sessions) <= self.max_sessions:
+                break
+            self.sessions.popitem(last=False)
+            expired.append(user_id)
+        if expired and self.persist:
+            asyncio.create_task(self.col.delete_many({"_id": {"$in": expired}}))
+
+    async def get(self, user_id):
+        if not self._loaded:
+            await self._load()
+        self.sweep()
+        return self.sessions.get(user_id)
+
+    async def save(self, session):
+        session.updated_at = time.time()
+        self.sessions[session.user_id] = session
+        self.sessions.move_to_end(session.user_id)
+        self.sweep()
+        if self.persist:
+            await self.col.replace_one({"_id": session.user_id}, session.to_doc(), upsert=True)
+
+    async def pop(self, user_id):
+        if not self._loaded:
+            await self._load()
+        session = self.sessions.pop(user_id, None)
+        if session and self.persist:
+            await self.col.delete_one({"_id": user_id})
+        return session
+
+    def __len__(self):
+        return len(self.sessions)
+
+# ========== BOT SETUP ==========
+if not all([Config.API_ID, Config.API_HASH, Config.BOT_TOKEN]):
+    print("❌ ERROR: Missing API credentials! Please set environment variables.")
+    print(f"API_ID: {'✅' if Config.API_ID else '❌'}")
+    print(f"API_HASH: {'✅' if Config.API_HASH else '❌'}")
+    print(f"BOT_TOKEN: {'✅' if Config.BOT_TOKEN else '❌'}")
+    exit(1)
+
+if Config.BOT_ROLE not in ("all", "frontend", "worker"):
+    print(f"❌ ERROR: BOT_ROLE must be all, frontend or worker, not {Config.BOT_ROLE!r}")
+    exit(1)
+
+if not PILLOW:
+    logging.warning("Pillow is not installed, thumbnails are used as sent")
+
+class BotClient(Client):
+    """Client whose chat-visible API calls go through the outbound limiter"""
+
+    async def invoke(self, query, *args, **kwargs):
+        priority = OUTBOUND_PRIORITIES.get(type(query))
+        if priority is None:
+            return await super().invoke(query, *args, **kwargs)
+        # Let FloodWait reach the limiter so it can park the bucket
+        kwargs["sleep_threshold"] = 0
+        return await outbound.call(
+            outbound_chat_key(query), priority, super().invoke, query, *args,
+            retry_flood=priority != PRIORITY_PROGRESS, **kwargs
+        )
+
+# Workers get their own session and never receive updates; those go to the front end
+app = BotClient(
+    f"rename_bot_{Config.WORKER_ID}" if Config.BOT_ROLE == "worker" else "rename_bot",
+    api_id=Config.API_ID,
+    api_hash=Config.API_HASH,
+    bot_token=Config.BOT_TOKEN,
+    no_updates=Config.BOT_ROLE == "worker"
+)
+
+# ========== GLOBAL VARIABLES ==========
+sessions = SessionStore(db.db.sessions, Config.SESSION_TTL, Config.SESSION_MAX, Config.SESSION_PERSIST)
+
+# ========== THUMBNAIL MANAGEMENT ==========
+@app.on_message(filters.private & filters.command(["view_thumb", "viewthumbnail"]))
+async def view_thumbnail(client, message):
+    thumbnail = await db.get_thumbnail(message.from_user.id)
+    if thumbnail:
+        await client.send_photo(message.chat.id, thumbnail, caption="**Your Current Thumbnail**")
+    else:
+        await message.reply_text("**You don't have any thumbnail set.**")
+
+@app.on_message(filters.private & filters.command(["del_thumb", "deletethumbnail"]))
+async def delete_thumbnail(client, message):
+    old_thumbnail = await db.get_thumbnail(message.from_user.id)
+    await db.set_thumbnail(message.from_user.id, None)
+    if old_thumbnail:
+        thumb_cache.drop(old_thumbnail)
+    await message.reply_text("**Thumbnail deleted successfully!**")
+
+@app.on_message(filters.private & filters.photo)
+async def save_thumbnail(client, message):
+    old_thumbnail = await db.get_thumbnail(message.from_user.id)
+    await db.set_thumbnail(message.from_user.id, message.photo.file_id)
+    if old_thumbnail and old_thumbnail != message.photo.file_id:
+        thumb_cache.drop(old_thumbnail)
+    try:
+        await thumb_cache.put(client, message.photo.file_id)
+    except Exception as e:
+        logging.warning(f"Thumbnail cache fill failed: {e}")
+    await message.reply_text("**Thumbnail saved successfully!**")
+
+# ========== CANCEL COMMAND ==========
+cancel_stats = {"jobs": 0, "bytes_saved": 0}
+
+async def cancel_job(job):
+    """Stop a job at its next chunk, or before it starts; its partial files are deleted"""
+    job.token.cancel()
+    cancel_stats["jobs"] += 1
+    cancel_stats["bytes_saved"] += job.bytes_left()
+    waiting = not job.task
+    scheduler.cancel(job)
+    if waiting:
+        await job.discard()
+    try:
+        await job.progress_msg.edit("**🛑 Cancelled**")
+    except Exception:
+        pass
+
+@app.on_message(filters.private & filters.command("cancel"))
+async def cancel_command(client, message):
+    user_id = message.from_user.id
+    session = await sessions.pop(user_id)
+    jobs = scheduler.user_active(user_id)
+    for job in jobs:
+        await cancel_job(job)
+    if Config.BOT_ROLE == "frontend":
+        entries = await job_queue.cancel_user(user_id)
+        for entry in entries:
+            try:
+                await client.edit_message_text(entry["chat_id"], entry["progress_message_id"], "**🛑 Cancelled**")
+            except Exception:
+                pass
+        jobs += entries
+    
+    if jobs:
+        await message.reply_text(f"**✅ Cancelled {len(jobs)} {'transfer' if len(jobs) == 1 else 'transfers'}!**")
+    elif session:
+        await message.reply_text("**✅ Process cancelled successfully!**")
+    else:
+        await message.reply_text("**❌ No active process to cancel.**")
+
+# ========== START COMMAND ==========
+@app.on_message(filters.private & filters.command("start"))
+async def start_command(client, message):
+    await message.reply_text(
+        "**👋 Hello! I'm a File Rename Bot**\n\n"
+        "**How to use:**\n"
+        "1. Send me any file (document/video/audio)\n"
+        "2. Click 'Rename' button\n"
+        "3. Enter new filename\n"
+        "4. Select upload type\n\n"
+        "**Batch Rename:**\n"
+        "Send or forward several files at once, then rename them all with a template like `Show S01E{n:02}`\n\n"
+        "**Thumbnail Commands:**\n"
+        "• Send a photo to set thumbnail\n"
+        "• /view_thumb - View current thumbnail\n"
+        "• /del_thumb - Delete thumbnail\n\n"
+        "**Other Commands:**\n"
+        "• /cancel - Cancel current process\n"
+        "• /status - Show queue status"
+    )
+
+# ========== FILE RENAME HANDLER ==========
+user_locks = weakref.WeakValueDictionary()  # user_id -> lock serializing that user's incoming files
+
+@app.on_message(filters.private & (filters.document | filters.video | filters.audio))
+async def handle_file(client, message):
+    user_id = message.from_user.id
+    
+    if shutdown.draining:
+        await message.reply_text(f"{RESTARTING_TEXT}Please send the file again in a minute.")
+        return
+    
+    # Get file info
+    if message.document:
+        file = message.document
+        file_type = "document"
+        duration = 0
+    elif message.video:
+        file = message.video
+        file_type = "video"
+        duration = getattr(file, 'duration', 0)
+    elif message.audio:
+        file = message.audio
+        file_type = "audio"
+        duration = getattr(file, 'duration', 0)
+    else:
+        return
+    width = getattr(file, 'width', 0) or 0
+    height = getattr(file, 'height', 0) or 0
+
+    file_name = getattr(file, 'file_name', 'Unknown')
+    file_bytes = getattr(file, 'file_size', 0) or 0
+    file_size = humanbytes(file_bytes)
+    
+    # Files of a media group arrive together, so one user's files are handled one at a time
+    lock = user_locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        session = await sessions.get(user_id)
+        
+        # A media group or a quick burst of files becomes one batch
+        if session:
+            in_burst = message.media_group_id or time.time() - session.updated_at <= Config.BATCH_WINDOW
+            if session.step == 'awaiting_rename' and in_burst:
+                if len(session.batch or []) + 1 >= Config.BATCH_MAX_FILES:
+                    await message.reply_text(f"**❌ A batch can hold at most {Config.BATCH_MAX_FILES} files.**")
+                    return
+                session.batch = (session.batch or []) + [{
+                    "message_id": message.id,
+                    "file_id": file.file_id,
+                    "file_unique_id": file.file_unique_id,
+                    "file_name": file_name,
+                    "file_size": file_bytes,
+                    "file_type": file_type,
+                    "duration": duration,
+                    "width": width,
+                    "height": height
+                }]
+                await sessions.save(session)
+                refresh_batch_prompt(client, user_id)
+                return
+            
+            # Block if user already has active process
+            await message.reply_text("**❌ Please complete your current process first!**\nUse /cancel to cancel.")
+            return
+        
+        # Shed load before the user goes through the rename dialog
+        try:
+            if Config.BOT_ROLE == "frontend":
+                await job_queue.check_capacity(user_id)
+            else:
+                scheduler.check_capacity(user_id)
+        except QueueFull as e:
+            await message.reply_text(f"**🚦 {e}**")
+            return
+        
+        # Store file info with duration
+        session = RenameSession(
+            user_id,
+            message.chat.id,
+            message.id,
+            file.file_id,
+            file.file_unique_id,
+            file_name,
+            file_bytes,
+            file_type,
+            duration,
+            width=width,
+            height=height
+        )
+        await sessions.save(session)
+
+        # Show file info with buttons - include duration
+        duration_text = convert_seconds(duration) if duration > 0 else "Not available"
+        
+        info_text = f"""**📁 File Information:**
+
+**Name:** `{file_name}`
+**Size:** `{file_size}`
+**Type:** `{file_type.title()}`
+**Duration:** `{duration_text}`
+
+**Click RENAME to continue.**"""
+
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Rename", callback_data="start_rename")]
+            # Removed cancel button
+        ])
+        
+        prompt = await message.reply_text(info_text, reply_markup=keyboard)
+        session.prompt_message_id = prompt.id
+        await sessions.save(session)
+
+# ========== CALLBACK HANDLERS ==========
+@app.on_callback_query(filters.regex("^start_rename$"))
+async def start_rename_callback(client, callback_query):
+    user_id = callback_query.from_user.id
+    session = await sessions.get(user_id)
+    
+    if not session:
+        await callback_query.answer("Session expired! Send file again.", show_alert=True)
+        return
+    
+    session.step = 'awaiting_filename'
+    
+    # Delete the rename prompt message
+    try:
+        await callback_query.message.delete()
+    except:
+        pass
+    
+    # Ask for filename directly without buttons
+    if session.batch:
+        ask_msg = await callback_query.message.reply_text(
+            f"**📝 Please reply with a name template for the {len(session.files())} files:**\n\n"
+            "`{n}` is the file's position and `{name}` its original name\n"
+            "Example: `Show S01E{n:02}`\n\n"
+            "**Note:** Don't include file extension"
+        )
+    else:
+        ask_msg = await callback_query.message.reply_text(
+            "**📝 Please reply with the new filename:**\n\n"
+            "**Note:** Don't include file extension\n"
+            "Example: `my_renamed_file`\n\n"
+            "💡 *You can reply to this message*"
+        )
+    
+    # Store the ask message ID for auto-reply
+    session.ask_message_id = ask_msg.id
+    await sessions.save(session)
+    
+    await callback_query.answer()
+
+@app.on_callback_query(filters.regex("^upload_(document|video)$"))
+async def upload_type_callback(client, callback_query):
+    user_id = callback_query.from_user.id
+    upload_type = callback_query.data.split("_")[1]
+    session = await sessions.get(user_id)
+    
+    if not session or session.step != 'awaiting_upload_type':
+        await callback_query.answer("Session expired!", show_alert=True)
+        return
+    
+    # Delete the selection message
+    try:
+        await callback_query.message.delete()
+    except:
+        pass
+    
+    if session.batch:
+        await submit_batch_job(client, callback_query.message, user_id, upload_type)
+        return
+    
+    new_filename = session.new_filename
+    
+    # Get original extension
+    original_ext = original_extension(session.file_name, session.file_type)
+    
+    final_filename = f"{new_filename}{original_ext}"
+    
+    # Check if file should be forced as document
+    if original_ext.lower() in FORCE_DOCUMENT_EXTENSIONS:
+        upload_type = "document"
+    
+    await submit_rename_job(client, callback_query.message, user_id, final_filename, upload_type)
+
+# ========== RENAME JOBS ==========
+def rename_job_doc(session, final_filename, upload_type):
+    """Everything needed to rebuild a RenameJob, for checkpoints and the shared queue"""
+    return {"session": session.state(), "final_filename": final_filename, "upload_type": upload_type}
+
+class RenameJob:
+    """One rename request waiting for, or holding, a scheduler slot"""
+
+    def __init__(self, client, session, final_filename, upload_type, progress_msg, checkpoint=None, job_id=None, token=None):
+        self.job_id = checkpoint.job_id if checkpoint else job_id or uuid.uuid4().hex[:12]
+        self.client = client
+        self.session = session
+        self.user_id = session.user_id
+        self.chat_id = session.chat_id
+        self.final_filename = final_filename
+        self.upload_type = upload_type
+        self.file_size = session.file_size
+        self.progress_msg = progress_msg
+        self.checkpoint = checkpoint or TransferCheckpoint(self.job_id, self.to_doc())
+        self.token = token or CancelToken()
+        self.progress = None
+        storage.claim(self.job_id)
+
+    def to_doc(self):
+        return rename_job_doc(self.session, self.final_filename, self.upload_type)
+
+    @classmethod
+    async def resume(cls, client, checkpoint):
+        """Rebuild a job a previous run left unfinished"""
+        doc = checkpoint.job
+        session = RenameSession(**doc["session"])
+        progress_msg = await client.send_message(
+            session.chat_id,
+            f"♻️ Resuming `{doc['final_filename']}` where it left off..."
+        )
+        return cls(client, session, doc["final_filename"], doc["upload_type"], progress_msg, checkpoint)
+
+    async def run(self):
+        return await run_rename_job(self)
+
+    def admit(self):
+        """Reserve the job's disk space before it takes a slot, False while there is none"""
+        return not uses_disk(self.file_size) or storage.try_reserve(self.job_id, self.file_size)
+
+    def bytes_left(self):
+        """Download and upload bytes this job still had ahead of it"""
+        return max(0, 2 * self.file_size - (self.progress.transferred() if self.progress else 0))
+
+    async def discard(self):
+        """Clean up after a job cancelled before it started"""
+        await storage.release(self.job_id)
+
+    def save_for_resume(self):
+        """Persist a job that has not started, so the next start picks it up"""
+        self.checkpoint.save(force=True)
+        return 1
+
+    async def notify_position(self, position):
+        try:
+            await self.progress_msg.edit(
+                f"**⏳ Queued**\n\n📄 **File:** `{self.final_filename}`\n\n"
+                f"**Position:** `{position}` of `{self.lane.depth()}` in the {self.lane.name} files lane"
+            )
+        except Exception:
+            pass
+
+async def submit_rename_job(client, reply_to, user_id, final_filename, upload_type):
+    """Hand the user's current file over to the scheduler"""
+    # The job id is picked up front so the submit spans carry it too
+    if shutdown.draining:
+        await reply_to.reply_text(f"{RESTARTING_TEXT}Your file is kept, please choose again in a minute.")
+        return
+    
+    job_id = uuid.uuid4().hex[:12]
+    token = trace_job.set(job_id)
+    try:
+        with timed("submit", user=user_id):
+            session = await sessions.pop(user_id)
+            if not session:
+                return
+            
+            # Repeats of an earlier rename are re-sent by file_id without a transfer
+            if await serve_cached_result(client, session, final_filename, upload_type):
+                return
+            
+            progress_msg = await reply_to.reply_text("🔄 Processing your file...")
+            
+            if Config.BOT_ROLE == "frontend":
+                try:
+                    await job_queue.submit(
+                        job_id, "rename", rename_job_doc(session, final_filename, upload_type),
+                        session, session.file_size, progress_msg, f"📄 **File:** `{final_filename}`"
+                    )
+                except QueueFull as e:
+                    await progress_msg.edit(f"**🚦 {e}**")
+                return
+            
+            job = RenameJob(client, session, final_filename, upload_type, progress_msg, job_id=job_id)
+            
+            try:
+                position = scheduler.submit(job)
+            except QueueFull as e:
+                await storage.release(job.job_id)
+                await progress_msg.edit(f"**🚦 {e}**")
+                return
+            
+            if position:
+                job.last_position = position
+                await job.notify_position(position)
+    finally:
+        trace_job.reset(token)
+
+def success_text(final_filename, upload_type, duration):
+    duration_text = convert_seconds(duration) if duration > 0 else "Unknown"
+    return (
+        f"**✅ File Renamed Successfully!**\n\n"
+        f"**New Name:** `{final_filename}`\n"
+        f"**Type:** `{upload_type.title()}`\n"
+        f"**Duration:** `{duration_text}`"
+    )
+
+async def serve_cached_result(client, session, final_filename, upload_type, announce=True):
+    """Re-send a previous identical rename, returns False on a cache miss.
+
+    Any failure on the way counts as a miss, so the caller falls back to a
+    normal transfer instead of losing the job.
+    """
+    chat_id = session.chat_id
+    try:
+        with timed("profile"):
+            thumbnail = await db.get_thumbnail(session.user_id)
+        key = result_cache.key(session.file_unique_id, final_filename, upload_type, thumbnail, session.duration)
+        with timed("result_cache"):
+            file_id = await result_cache.get(key)
+    except Exception as e:
+        logging.warning(f"Result cache lookup failed: {e}")
+        return False
+    if not file_id:
+        return False
+    
+    try:
+        await client.send_cached_media(chat_id, file_id, caption=f"`{final_filename}`")
+    except (FileIdInvalid, FileReferenceExpired, FileReferenceInvalid, MediaEmpty):
+        try:
+            await result_cache.invalidate(key)
+        except Exception as e:
+            logging.warning(f"Could not invalidate cached result: {e}")
+        return False
+    except Exception as e:
+        logging.warning(f"Could not re-send cached result: {e}")
+        return False
+    
+    if announce:
+        try:
+            await client.send_message(chat_id, success_text(final_filename, upload_type, session.duration))
+        except Exception as e:
+            # The file itself was delivered, so this is still a hit
+            logging.warning(f"Could not announce cached result: {e}")
+    return True
+
+async def transfer_job(job, progress):
+    """Transfer one job's file, resuming from its checkpoint after transient failures.
+
+    Returns the duration the file was sent with. The job's storage is freed
+    once it finishes either way, and kept for a resume when it is cancelled.
+    """
+    client = job.client
+    session = job.session
+    checkpoint = job.checkpoint
+    original_duration = session.duration
+    thumbnail = None
+    thumb_path = None
+    probed = None
+    started = time.monotonic()
+    trace_job.set(job.job_id)
+    
+    try:
+        checkpoint.save(force=True)
         
         # Get thumbnail
-        thumbnail = await db.get_thumbnail(user_id)
-        thumb_path = None
+        with timed("profile"):
+            thumbnail = await db.get_thumbnail(job.user_id)
         if thumbnail:
             try:
-                thumb_path = await client.download_media(thumbnail)
-            except:
-                pass
+                with timed("thumbnail"):
+                    thumb_path = await thumb_cache.acquire(client, thumbnail)
+            except Exception as e:
+                logging.warning(f"Thumbnail unavailable: {e}")
+        
+        for attempt in range(Config.TRANSFER_RETRIES + 1):
+            try:
+                original_message = await session.fetch_message(client)
+                
+                # Read duration and dimensions from the headers when Telegram did not supply them
+                if probed is None:
+                    with timed("probe"):
+                        probed = await media_probe.for_job(client, original_message, session, job.upload_type)
+                
+                sent = await transfer_file(
+                    client,
+                    job.chat_id,
+                    original_message,
+                    session.file_size,
+                    job.final_filename,
+                    job.upload_type,
+                    original_duration or round(probed.get("duration", 0)),
+                    thumb_path,
+                    progress,
+                    checkpoint,
+                    width=session.width or probed.get("width", 0),
+                    height=session.height or probed.get("height", 0)
+                )
+                break
+            except TRANSIENT_ERRORS as e:
+                checkpoint.flush()
+                if attempt == Config.TRANSFER_RETRIES:
+                    raise
+                delay = retry_delay(attempt, e)
+                logging.warning(f"Job {job.job_id} failed ({e}), retrying in {delay:.1f}s")
+                progress.set_stage(f"♻️ **Retrying ({attempt + 1}/{Config.TRANSFER_RETRIES})**")
+                await asyncio.sleep(delay)
         
-        # Upload file with progress (no separate "Uploading" message)
-        start_time = time.time()
+        # Remember the result so an identical rename can skip the transfer. A file
+        # that went out without the user's thumbnail must not stand in for one with it
+        media = getattr(sent, sent.media.value, None) if sent and sent.media else None
+        if media and (not thumbnail or thumb_path):
+            key = result_cache.key(session.file_unique_id, job.final_filename, job.upload_type, thumbnail, original_duration)
+            try:
+                await result_cache.put(key, media.file_id, job.final_filename)
+            except Exception as e:
+                logging.warning(f"Result cache store failed: {e}")
+    
+    except asyncio.CancelledError:
+        # Shutting down: keep the checkpoint so the next start resumes this job.
+        # Cancelled by the user: throw the partial data away
+        checkpoint.flush()
+        await storage.release(job.job_id, keep_files=not job.token.cancelled)
+        raise
+    
+    except Exception:
+        await storage.release(job.job_id)
+        raise
+    
+    finally:
+        # The cached thumbnail stays on disk for the next job
+        if thumb_path:
+            thumb_cache.release(thumbnail)
+    
+    await storage.release(job.job_id)
+    elapsed = time.monotonic() - started
+    stage_latency.observe("job", elapsed)
+    trace_span("job", elapsed, size=session.file_size, upload_type=job.upload_type)
+    if startup_stats["first_job"] is None:
+        startup_stats["first_job"] = elapsed
+        print(f"⏱️ First job since startup took {elapsed:.1f}s")
+    return original_duration or round(probed.get("duration", 0))
+
+async def run_rename_job(job):
+    """Download, rename and re-upload one file, returns 'done' or 'failed'"""
+    client = job.client
+    
+    progress = ProgressRenderer(job.progress_msg, job.final_filename, token=job.token)
+    job.progress = progress
+    progress.start()
+    
+    try:
+        duration = await transfer_job(job, progress)
         
-        # Check if file should be forced as document
-        force_document = False
-        if original_ext.lower() in ['.pdf', '.html', '.htm', '.txt', '.doc', '.docx']:
-            force_document = True
-            upload_type = "document"
+        # Success message
+        await client.send_message(job.chat_id, success_text(job.final_filename, job.upload_type, duration))
         
-        if upload_type == "document" or force_document:
-            await client.send_document(
-                callback_query.message.chat.id,
-                document=file_path,
-                thumb=thumb_path,
-                caption=f"`{final_filename}`",
-                progress=progress_for_pyrogram,
-                progress_args=("📤 **Uploading File**", progress_msg, start_time, final_filename)
-            )
-        else:  # video
-            await client.send_video(
-                callback_query.message.chat.id,
-                video=file_path,
-                thumb=thumb_path,
-                caption=f"`{final_filename}`",
-                duration=original_duration,
-                supports_streaming=True,
-                progress=progress_for_pyrogram,
-                progress_args=("📤 **Uploading File**", progress_msg, start_time, final_filename)
+        # Cleanup progress message
+        try:
+            await job.progress_msg.delete()
+        except Exception:
+            pass
+        return "done"
+    
+    except JobCancelled:
+        raise
+    
+    except Exception as e:
+        error_msg = f"**❌ Error:** `{str(e)}`"
+        await client.send_message(job.chat_id, error_msg)
+        logging.error(f"Upload error: {e}")
+        return "failed"
+    
+    finally:
+        await progress.stop()
+
+def recent_checkpoints():
+    """Readable checkpoints left on disk that are young enough to resume"""
+    now = time.time()
+    checkpoints = []
+    for name in os.listdir(storage.home.path):
+        path = os.path.join(storage.job_dir(name), "checkpoint.json")
+        if not os.path.isfile(path):
+            continue
+        try:
+            checkpoint = TransferCheckpoint.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Unreadable checkpoint {path}: {e}")
+            continue
+        if now - checkpoint.created_at > Config.CHECKPOINT_MAX_AGE_HOURS * 3600:
+            continue
+        checkpoints.append(checkpoint)
+    return checkpoints
+
+async def resume_unfinished_jobs(client):
+    """Resubmit jobs a previous run left unfinished and sweep away everything else"""
+    checkpoints = recent_checkpoints()
+    storage.sweep(keep={checkpoint.job_id for checkpoint in checkpoints})
+    
+    for checkpoint in checkpoints:
+        try:
+            job = await RenameJob.resume(client, checkpoint)
+        except Exception as e:
+            logging.warning(f"Could not resume job {checkpoint.job_id}: {e}")
+            await storage.release(checkpoint.job_id)
+            continue
+        try:
+            position = scheduler.submit(job)
+        except QueueFull as e:
+            await storage.release(job.job_id)
+            await job.progress_msg.edit(f"**🚦 {e}**")
+            continue
+        if position:
+            job.last_position = position
+            await job.notify_position(position)
+    
+    if checkpoints:
+        logging.info(f"Resumed {len(checkpoints)} unfinished jobs")
+
+# ========== BATCH RENAME ==========
+BATCH_FIELDS = {"n", "name"}
+prompt_updates = {}  # user_id -> pending edit of the batch prompt
+
+def batch_template(template, count):
+    """Check a batch name template, adding a number when it has none"""
+    parsed = [(field, spec) for _, field, spec, _ in string.Formatter().parse(template) if field is not None]
+    fields = {field for field, _ in parsed}
+    if not fields <= BATCH_FIELDS:
+        raise ValueError("Only {n} and {name} can be used in a template")
+    if any(not re.fullmatch(r"0?\d{0,2}d?", spec) for _, spec in parsed):
+        raise ValueError("Only a zero-padded width like {n:02} is supported")
+    if "n" not in fields:
+        template = f"{template} {{n:0{len(str(count))}}}"
+    return template
+
+def batch_filename(template, n, session):
+    """Name for the n-th file of a batch, keeping the file's own extension"""
+    stem, _ = os.path.splitext(session.file_name or "")
+    name = re.sub(r'[<>:"/\\|?*]', '', template.format(n=n, name=stem)).strip()
+    if not name:
+        raise ValueError("The template gives an empty filename")
+    return name + original_extension(session.file_name, session.file_type)
+
+def refresh_batch_prompt(client, user_id):
+    """Show the current batch size, at most one edit per burst of files"""
+    if user_id in prompt_updates:
+        return
+
+    async def update():
+        await asyncio.sleep(1)
+        prompt_updates.pop(user_id, None)
+        session = await sessions.get(user_id)
+        if not session or not session.batch or not session.prompt_message_id:
+            return
+        files = session.files()
+        try:
+            await client.edit_message_text(
+                session.chat_id,
+                session.prompt_message_id,
+                f"**📦 Batch of {len(files)} files** "
+                f"(`{humanbytes(sum(f.file_size for f in files))}`)\n\n"
+                f"**First:** `{files[0].file_name}`\n"
+                f"**Last:** `{files[-1].file_name}`\n\n"
+                "Keep sending files to add them, then click RENAME to name them all with one template.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Rename", callback_data="start_rename")]])
             )
-        
-        # Success message
-        duration_text = convert_seconds(original_duration) if original_duration > 0 else "Unknown"
-        await callback_query.message.reply_text(
-            f"**✅ File Renamed Successfully!**\n\n"
-            f"**New Name:** `{final_filename}`\n"
-            f"**Type:** `{upload_type.title()}`\n"
-            f"**Duration:** `{duration_text}`"
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logging.warning(f"Batch prompt update failed: {e}")
+
+    prompt_updates[user_id] = asyncio.create_task(update())
+
+class BatchProgress:
+    """One progress message for every file of a batch"""
+
+    def __init__(self, message, count, total_bytes, token=None):
+        self.renderer = ProgressRenderer(message, f"{count} files", token=token)
+        self.count = count
+        self.total_bytes = total_bytes
+        self.done = {}  # file index -> bytes transferred
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        self._set_title()
+        self.renderer.start()
+
+    async def stop(self):
+        await self.renderer.stop()
+
+    def _set_title(self):
+        title = f"📦 **Batch: {self.completed}/{self.count} done**"
+        if self.failed:
+            title += f", {self.failed} failed"
+        self.renderer.set_title(title)
+
+    def file_progress(self, index, size):
+        return BatchFileProgress(self, index, size)
+
+    def report(self, index, done):
+        self.done[index] = done
+        self.renderer.update(sum(self.done.values()), self.total_bytes)
+
+    def finish_file(self, index, size, ok):
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.report(index, size)
+        self._set_title()
+
+class BatchFileProgress:
+    """A batch file's view on BatchProgress, usable wherever a ProgressRenderer is"""
+    __slots__ = ("batch", "index", "size")
+
+    def __init__(self, batch, index, size):
+        self.batch = batch
+        self.index = index
+        self.size = size
+
+    @property
+    def token(self):
+        return self.batch.renderer.token
+
+    def update(self, current, total):
+        # Download and upload each count the file once, so only forward movement is shown
+        done = max(self.batch.done.get(self.index, 0), min(current, self.size))
+        self.batch.report(self.index, done)
+
+    def set_stage(self, ud_type, directions=1):
+        pass
+
+class BatchJob:
+    """Every file of one batch rename, sharing a single progress message.
+
+    Each file is queued as its own BatchFileJob, so the files take slots in
+    their own size lane and count against the user's limits like single
+    files do. Cancelling one file cancels the batch, since all of them share
+    the batch's token.
+    """
+
+    def __init__(self, client, session, template, upload_type, progress_msg, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.client = client
+        self.user_id = session.user_id
+        self.chat_id = session.chat_id
+        self.upload_type = upload_type
+        self.progress_msg = progress_msg
+        self.token = CancelToken()
+        self.files = []
+        for n, item in enumerate(session.files(), 1):
+            final_filename = batch_filename(template, n, item)
+            item_type = "document" if final_filename.lower().endswith(FORCE_DOCUMENT_EXTENSIONS) else upload_type
+            self.files.append(BatchFileJob(self, n - 1, item, final_filename, item_type))
+        self.file_size = sum(job.file_size for job in self.files)
+        self.progress = BatchProgress(progress_msg, len(self.files), self.file_size, token=self.token)
+        self.started = set()  # indexes of files that began transferring
+        self.running = 0  # files given a slot and not ended yet
+        self.failures = []
+        self.pending = len(self.files)
+        self.finished = asyncio.Event()
+        self.lease = None  # the LeasedJob when a worker claimed this batch from the shared queue
+        self.task = None
+
+    async def run(self):
+        """Queue every file and report once all of them ended, returns 'failed' if any file failed"""
+        position = [scheduler.submit(job, force=True) for job in self.files][0]
+        try:
+            if position:
+                self.files[0].last_position = position
+                await self.files[0].notify_position(position)
+            await self.finished.wait()
+        finally:
+            await self.progress.stop()
+        if self.token.cancelled:
+            raise JobCancelled()
+
+        text = (
+            f"**✅ Batch Finished!**\n\n"
+            f"**Renamed:** `{len(self.files) - len(self.failures)}` of `{len(self.files)}`\n"
+            f"**Type:** `{self.upload_type.title()}`"
         )
+        if self.failures:
+            text += "\n\n**❌ Failed:**\n" + "\n".join(
+                f"• `{name}`: `{error}`" for name, error in self.failures[:10]
+            )
+            if len(self.failures) > 10:
+                text += f"\n• ...and {len(self.failures) - 10} more"
+        await self.client.send_message(self.chat_id, text)
         
-        # Cleanup progress message
         try:
-            await progress_msg.delete()
-        except:
+            await self.progress_msg.delete()
+        except Exception:
             pass
-            
-    except Exception as e:
-        error_msg = f"**❌ Error:** `{str(e)}`"
-        await callback_query.message.reply_text(error_msg)
-        logging.error(f"Upload error: {e}")
+        return "failed" if self.failures else "done"
+
+    async def run_file(self, job):
+        """Transfer one file of the batch, returns 'done' or 'failed'"""
+        if not self.started:
+            self.progress.start()
+        self.started.add(job.index)
+        try:
+            if self.token.cancelled:
+                raise JobCancelled()
+            if await serve_cached_result(self.client, job.session, job.final_filename, job.upload_type, announce=False):
+                await storage.release(job.job_id)
+            else:
+                await transfer_job(job, self.progress.file_progress(job.index, job.file_size))
+        except (JobCancelled, asyncio.CancelledError):
+            # A file stopped for a restart is saved to continue, so only cancelling ends it
+            if self.token.cancelled:
+                self.file_ended(job)
+            raise
+        except Exception as e:
+            logging.error(f"Batch {self.job_id} file {job.final_filename} failed: {e}")
+            self.file_ended(job, e)
+            return "failed"
+        finally:
+            self.running -= 1
+        self.file_ended(job)
+        return "done"
+
+    def file_ended(self, job, error=None):
+        """Count a file as done, failed or cancelled; the last one finishes the batch"""
+        if not self.token.cancelled:
+            if error:
+                self.failures.append((job.final_filename, error))
+            self.progress.finish_file(job.index, job.file_size, error is None)
+        self.pending -= 1
+        if not self.pending:
+            self.finished.set()
+
+class BatchFileJob(RenameJob):
+    """One file of a batch, scheduled on its own but reporting to its batch"""
+
+    def __init__(self, batch, index, session, final_filename, upload_type):
+        super().__init__(batch.client, session, final_filename, upload_type, batch.progress_msg, token=batch.token)
+        self.batch = batch
+        self.index = index
+
+    async def run(self):
+        return await self.batch.run_file(self)
+
+    def admit(self):
+        """Keep to BATCH_PARALLELISM files of the batch at once, inside the user's own limit"""
+        if self.batch.running >= Config.BATCH_PARALLELISM or not super().admit():
+            return False
+        self.batch.running += 1
+        return True
+
+    def bytes_left(self):
+        done = self.batch.progress.done.get(self.index, 0)
+        return max(0, 2 * (self.file_size - done))
+
+    async def discard(self):
+        await super().discard()
+        self.batch.file_ended(self)
+
+    async def notify_position(self, position):
+        # The first file speaks for the batch until one of its files starts
+        if self.index or self.batch.started:
+            return
+        try:
+            await self.progress_msg.edit(
+                f"**⏳ Queued**\n\n📦 **Batch:** `{len(self.batch.files)}` files\n\n"
+                f"**Position:** `{position}` of `{self.lane.depth()}` in the {self.lane.name} files lane"
+            )
+        except Exception:
+            pass
+
+async def submit_batch_job(client, reply_to, user_id, upload_type):
+    """Hand the user's batch over to the scheduler"""
+    if shutdown.draining:
+        await reply_to.reply_text(f"{RESTARTING_TEXT}Your files are kept, please choose again in a minute.")
+        return
     
-    finally:
-        # Cleanup files
-        if 'file_path' in locals() and file_path and os.path.exists(file_path):
+    session = await sessions.pop(user_id)
+    if not session:
+        return
+    
+    progress_msg = await reply_to.reply_text(f"🔄 Processing your batch of {len(session.files())} files...")
+    
+    if Config.BOT_ROLE == "frontend":
+        files = session.files()
+        try:
+            await job_queue.submit(
+                uuid.uuid4().hex[:12], "batch",
+                {"session": session.state(), "template": session.new_filename, "upload_type": upload_type},
+                session, sum(item.file_size for item in files), progress_msg,
+                f"📦 **Batch:** `{len(files)}` files"
+            )
+        except QueueFull as e:
+            await progress_msg.edit(f"**🚦 {e}**")
+        return
+    
+    # The batch is admitted as a whole, then its files queue past the queue limits
+    try:
+        scheduler.check_capacity(user_id)
+    except QueueFull as e:
+        scheduler.counters["rejected"] += 1
+        await progress_msg.edit(f"**🚦 {e}**")
+        return
+    
+    job = BatchJob(client, session, session.new_filename, upload_type, progress_msg)
+    job.task = asyncio.create_task(run_batch_job(job))
+
+async def run_batch_job(batch):
+    """Run a batch to its end, logging what a task would otherwise swallow"""
+    try:
+        await batch.run()
+    except JobCancelled:
+        pass
+    except Exception as e:
+        logging.error(f"Batch {batch.job_id} failed: {e}")
+
+# ========== SHARED JOB QUEUE ==========
+class LeasedJob:
+    """A job claimed from the shared queue, run by the local scheduler.
+
+    Reads and writes of anything but its own fields go to the wrapped job, so
+    the scheduler sees a normal job. The lease is renewed from the moment of
+    the claim; if another worker takes the job over, it is stopped here.
+    """
+    OWN_FIELDS = ("job", "queue", "heartbeat", "lost")
+
+    def __init__(self, job, queue):
+        object.__setattr__(self, "job", job)
+        object.__setattr__(self, "queue", queue)
+        object.__setattr__(self, "lost", False)
+        object.__setattr__(self, "heartbeat", asyncio.create_task(self._heartbeat()))
+
+    def __getattr__(self, name):
+        return getattr(self.job, name)
+
+    def __setattr__(self, name, value):
+        if name in self.OWN_FIELDS:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.job, name, value)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
             try:
-                os.remove(file_path)
-            except:
-                pass
-        if 'thumb_path' in locals() and thumb_path and os.path.exists(thumb_path):
+                renewed = await self.queue.renew(self.job_id)
+            except Exception as e:
+                logging.warning(f"Could not renew the lease on job {self.job_id}: {e}")
+                continue
+            if not renewed:
+                logging.warning(f"Lost the lease on job {self.job_id}, stopping it here")
+                self.queue.counters["lost"] += 1
+                self.lost = True
+                # Taken over or cancelled from the front end: stop and drop the partial data
+                self.job.token.cancel()
+                task = getattr(self.job, "task", None)
+                if task:
+                    task.cancel()
+                return
+
+    async def run(self):
+        status = None
+        try:
+            if not self.lost:
+                status = await self.job.run()
+        except (JobCancelled, asyncio.CancelledError):
+            if self.job.token.cancelled and not self.lost:
+                await self.queue.finish(self.job_id, "cancelled")
+            raise
+        except Exception:
+            if not self.lost:
+                await self.queue.finish(self.job_id, "failed")
+            raise
+        finally:
+            self.heartbeat.cancel()
+        if not self.lost:
+            await self.queue.finish(self.job_id, status or "done")
+        return status
+
+class JobQueue:
+    """Rename jobs in a Mongo collection, shared by front ends and workers.
+
+    Front ends insert jobs as ``queued``. A worker claims the oldest job with
+    one atomic update that marks it ``running`` under its own name until
+    ``lease_until``, and keeps pushing the lease forward while the job runs.
+    Jobs whose lease ran out, because their worker died, are claimed again
+    by the next worker, up to JOB_MAX_ATTEMPTS times.
+    """
+
+    def __init__(self, collection, owner, lease_seconds, poll_seconds, max_attempts):
+        self.col = collection
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.counters = {"enqueued": 0, "claimed": 0, "reclaimed": 0, "lost": 0, "finished": 0, "abandoned": 0}
+        self._indexed = False
+
+    async def _ensure_indexes(self):
+        if not self._indexed:
+            await self.col.create_index([("status", 1), ("created_at", 1)])
+            await self.col.create_index([("user_id", 1), ("status", 1)])
+            await self.col.create_index("finished_at", expireAfterSeconds=86400)
+            self._indexed = True
+
+    async def warm(self):
+        """Create the indexes at startup instead of on the first submit or claim"""
+        await self._ensure_indexes()
+
+    async def check_capacity(self, user_id):
+        """Raise QueueFull if a new job from this user would be shed"""
+        await self._ensure_indexes()
+        if await self.col.count_documents({"status": "queued"}) >= Config.MAX_QUEUED_JOBS:
+            raise QueueFull("Bot is busy right now, please try again in a few minutes.")
+        mine = await self.col.count_documents({"user_id": user_id, "status": {"$in": ["queued", "running"]}})
+        if mine >= Config.MAX_QUEUED_PER_USER:
+            raise QueueFull(f"You already have {mine} files in progress, wait for them to finish.")
+
+    async def submit(self, job_id, kind, job, session, file_size, progress_msg, label):
+        """Queue a job for the workers and show its place in line"""
+        await self.check_capacity(session.user_id)
+        created_at = datetime.utcnow()
+        await self.col.insert_one({
+            "_id": job_id,
+            "kind": kind,
+            "job": job,
+            "user_id": session.user_id,
+            "chat_id": session.chat_id,
+            "progress_message_id": progress_msg.id,
+            "file_size": file_size,
+            "status": "queued",
+            "attempts": 0,
+            "owner": None,
+            "lease_until": None,
+            "created_at": created_at
+        })
+        self.counters["enqueued"] += 1
+        position = await self.col.count_documents({"status": "queued", "created_at": {"$lte": created_at}})
+        try:
+            await progress_msg.edit(f"**⏳ Queued**\n\n{label}\n\n**Position:** `{position}` waiting for a worker")
+        except Exception:
+            pass
+
+    async def claim(self):
+        """Take the oldest queued or abandoned job, None when there is nothing to do"""
+        await self._ensure_indexes()
+        now = datetime.utcnow()
+        entry = await self.col.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "running", "lease_until": {"$lt": now}}]},
+            {
+                "$set": {"status": "running", "owner": self.owner, "lease_until": now + timedelta(seconds=self.lease_seconds)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if entry:
+            self.counters["claimed"] += 1
+            if entry["attempts"] > 1:
+                self.counters["reclaimed"] += 1
+        return entry
+
+    async def renew(self, job_id):
+        """Push a held lease forward, False if this worker no longer holds it"""
+        result = await self.col.update_one(
+            {"_id": job_id, "owner": self.owner, "status": "running"},
+            {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+        )
+        return result.matched_count == 1
+
+    async def release(self, job_id):
+        """Hand a claimed job back to the queue without counting the attempt"""
+        await self.col.update_one(
+            {"_id": job_id, "owner": self.owner},
+            {"$set": {"status": "queued", "owner": None, "lease_until": None}, "$inc": {"attempts": -1}}
+        )
+
+    async def finish(self, job_id, status):
+        await self.col.update_one(
+            {"_id": job_id, "owner": self.owner},
+            {"$set": {"status": status, "finished_at": datetime.utcnow()}}
+        )
+        self.counters["finished"] += 1
+
+    async def cancel_user(self, user_id):
+        """Cancel a user's queued and running jobs; workers stop theirs at the next lease renewal"""
+        pending = {"user_id": user_id, "status": {"$in": ["queued", "running"]}}
+        entries = [entry async for entry in self.col.find(pending, projection={"status": 1, "file_size": 1, "chat_id": 1, "progress_message_id": 1})]
+        if not entries:
+            return []
+        await self.col.update_many(
+            {"_id": {"$in": [entry["_id"] for entry in entries]}, "status": {"$in": ["queued", "running"]}},
+            {"$set": {"status": "cancelled", "finished_at": datetime.utcnow()}}
+        )
+        cancel_stats["jobs"] += len(entries)
+        cancel_stats["bytes_saved"] += sum(2 * entry["file_size"] for entry in entries if entry["status"] == "queued")
+        return entries
+
+    async def stats(self):
+        return {
+            status: await self.col.count_documents({"status": status})
+            for status in ("queued", "running")
+        }
+
+    async def _build(self, client, entry):
+        """Turn a claimed entry back into a RenameJob or BatchJob bound to this worker's client"""
+        doc = entry["job"]
+        session = RenameSession(**doc["session"])
+        progress_msg = await client.get_messages(entry["chat_id"], entry["progress_message_id"])
+        if not progress_msg or progress_msg.empty:
+            progress_msg = await client.send_message(entry["chat_id"], "🔄 Processing your file...")
+        if entry["kind"] == "batch":
+            return BatchJob(client, session, doc["template"], doc["upload_type"], progress_msg, job_id=entry["_id"])
+
+        # A job this host worked on before carries on from its checkpoint
+        checkpoint = None
+        path = os.path.join(storage.job_dir(entry["_id"]), "checkpoint.json")
+        if os.path.isfile(path):
             try:
-                os.remove(thumb_path)
-            except:
-                pass
-        
-        # Clear user state
-        if user_id in user_states:
-            del user_states[user_id]
+                checkpoint = TransferCheckpoint.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Unreadable checkpoint {path}: {e}")
+        return RenameJob(
+            client, session, doc["final_filename"], doc["upload_type"], progress_msg,
+            checkpoint, job_id=entry["_id"]
+        )
+
+    async def _abandon(self, client, entry):
+        await self.finish(entry["_id"], "failed")
+        self.counters["abandoned"] += 1
+        try:
+            await client.send_message(
+                entry["chat_id"],
+                "**❌ Error:** `The transfer kept getting interrupted, please send the file again.`"
+            )
+        except Exception:
+            pass
+
+    async def run_worker(self, client):
+        """Claim jobs whenever the local scheduler has a free slot, until the bot drains"""
+        while not shutdown.draining:
+            if scheduler.total_running + scheduler.queue_depth() >= scheduler.max_running:
+                await asyncio.sleep(self.poll_seconds)
+                continue
+            try:
+                entry = await self.claim()
+            except Exception as e:
+                logging.warning(f"Could not claim a job: {e}")
+                entry = None
+            if entry is None:
+                await asyncio.sleep(self.poll_seconds)
+                continue
+            if shutdown.draining:
+                await self.release(entry["_id"])
+                return
+            if entry["attempts"] > self.max_attempts:
+                await self._abandon(client, entry)
+                continue
+
+            try:
+                job = await self._build(client, entry)
+            except Exception as e:
+                logging.error(f"Could not start job {entry['_id']}: {e}")
+                await self._abandon(client, entry)
+                continue
+
+            leased = LeasedJob(job, self)
+            try:
+                if isinstance(job, BatchJob):
+                    # Its files take the slots, the batch only waits for them under its lease
+                    scheduler.check_capacity(job.user_id)
+                    job.lease = leased
+                    leased.task = asyncio.create_task(run_batch_job(leased))
+                else:
+                    scheduler.submit(leased)
+            except QueueFull:
+                # This user's other jobs fill their share here, leave it to another worker
+                leased.heartbeat.cancel()
+                if isinstance(job, RenameJob):
+                    await storage.release(job.job_id, keep_files=True)
+                else:
+                    for file_job in job.files:
+                        await storage.release(file_job.job_id)
+                await self.release(entry["_id"])
+                await asyncio.sleep(self.poll_seconds)
+
+job_queue = JobQueue(
+    db.db.jobs,
+    f"{Config.WORKER_ID}:{os.getpid()}:{uuid.uuid4().hex[:6]}",
+    Config.JOB_LEASE_SECONDS,
+    Config.JOB_POLL_SECONDS,
+    Config.JOB_MAX_ATTEMPTS
+)
+
+# ========== STATUS COMMAND ==========
+@app.on_message(filters.private & filters.command("status"))
+async def status_command(client, message):
+    stats = scheduler.stats()
+    outbound_stats = outbound.stats()
+    lane_lines = "\n".join(
+        f"• **{name.title()}:** `{lane['running']}`/`{lane['slots']}` running, `{lane['queued']}` queued, "
+        f"p95 wait `{TimeFormatter(lane['wait_p95'] * 1000)}`"
+        for name, lane in stats['lanes'].items()
+    )
+    storage_lines = "\n".join(
+        f"**Storage ({name}):** `{humanbytes(root['reserved'])}` reserved of `{humanbytes(root['quota'])}`, "
+        f"`{humanbytes(root['used'])}` used, `{humanbytes(root['free'])}` free"
+        for name, root in storage.stats().items()
+    )
+    rates = {}
+    for (dc_id, n), total in sorted(download_stats["connections"].items()):
+        rate = total["bytes"] / total["seconds"] if total["seconds"] else 0
+        rates.setdefault(dc_id, []).append(f"{humanbytes(rate)}/s")
+    connection_lines = "".join(
+        f"**Download DC{dc_id}:** `{', '.join(dc_rates)}` per connection\n" for dc_id, dc_rates in rates.items()
+    )
+    shared_line = ""
+    if Config.BOT_ROLE != "all":
+        shared = await job_queue.stats()
+        shared_line = f"**Shared Queue:** `{shared['queued']}` queued, `{shared['running']}` running on workers\n"
+    await message.reply_text(
+        "**📊 Queue Status**\n\n"
+        f"{shared_line}"
+        f"**Running:** `{stats['running']}` / `{scheduler.max_running}`\n"
+        f"**Queued:** `{stats['queued']}` from `{stats['waiting_users']}` users\n"
+        f"**Your Jobs:** `{scheduler.user_jobs(message.from_user.id)}`\n\n"
+        f"{lane_lines}\n\n"
+        f"**Wait p50:** `{TimeFormatter(stats['wait_p50'] * 1000)}`\n"
+        f"**Wait p95:** `{TimeFormatter(stats['wait_p95'] * 1000)}`\n"
+        f"**Oldest Waiting:** `{TimeFormatter(stats['oldest_wait'] * 1000)}`\n\n"
+        f"**Completed:** `{stats['completed']}` • **Failed:** `{stats['failed']}` • **Rejected:** `{stats['rejected']}`\n"
+        f"**Cancelled:** `{cancel_stats['jobs']}` jobs, `{humanbytes(cancel_stats['bytes_saved'])}` not transferred\n"
+        f"**Cache Hit Rate:** `{result_cache.hit_rate() * 100:.1f}%` ({result_cache.counters['hits']} hits)\n"
+        f"**Thumbnail Cache:** `{thumb_cache.hit_rate() * 100:.1f}%` hits, "
+        f"`{humanbytes(thumb_cache.counters['bytes_saved'])}` saved\n"
+        f"**Uploaded:** `{humanbytes(upload_stats['bytes'])}` in `{upload_stats['files']}` files, "
+        f"`{upload_stats['retries']}` part retries\n"
+        f"{connection_lines}"
+        f"**In Memory:** `{memory_budget.counters['files']}` files, "
+        f"`{memory_budget.counters['overflows']}` sent to disk, peak `{humanbytes(memory_budget.peak)}`\n"
+        f"{storage_lines}\n"
+        f"**Media Probes:** `{probe_stats['found']}`/`{probe_stats['probes']}` parsed, "
+        f"`{probe_stats['hits']}` cached, `{humanbytes(probe_stats['bytes'])}` read\n"
+        f"**Progress Edits:** `{progress_stats['edits_sent']}` sent, "
+        f"`{progress_stats['samples'] - progress_stats['edits_sent']}` suppressed\n"
+        f"**API Wait p95:** `{outbound_stats['wait_p95']['reply'] * 1000:.0f}ms` replies, "
+        f"`{outbound_stats['wait_p95']['progress'] * 1000:.0f}ms` progress • "
+        f"**FloodWaits:** `{outbound_stats['flood_waits']}`"
+    )
+
+# ========== PROFILER ==========
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+
+def collapse_stack(frame):
+    """One stack in the collapsed format read by flamegraph.pl and speedscope"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class LoopProfiler:
+    """Sample the event loop thread's stack from a helper thread.
+
+    A ticker task on the loop stamps the time every sample interval. When the
+    sampler sees the stamp fall behind by more than the stall threshold the
+    loop is blocked, and the stack it is stuck in is recorded with the stall.
+    """
+
+    def __init__(self, stall_threshold):
+        self.stall_threshold = stall_threshold
+        self.running = False
+        self.last_tick = 0
+
+    async def run(self, seconds):
+        """Profile for `seconds`, returns (collapsed stack counts, stalls)"""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        loop = asyncio.get_running_loop()
+        self.last_tick = time.monotonic()
+        ticker = asyncio.create_task(self._tick())
+        try:
+            return await loop.run_in_executor(None, self._sample, threading.get_ident(), seconds)
+        finally:
+            ticker.cancel()
+            self.running = False
+
+    async def _tick(self):
+        while True:
+            self.last_tick = time.monotonic()
+            await asyncio.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    def _sample(self, thread_id, seconds):
+        stacks = {}
+        stalls = []  # (seconds blocked, stack)
+        stall_from = None
+        stall_stack = None
+        deadline = time.monotonic() + seconds
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = collapse_stack(frame)
+            del frame
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+            tick = self.last_tick
+            if now - tick - PROFILE_SAMPLE_INTERVAL > self.stall_threshold:
+                if stall_from != tick:
+                    # A new stall: the first stack seen is the one blocking the loop
+                    if stall_from is not None:
+                        stalls.append((tick - stall_from - PROFILE_SAMPLE_INTERVAL, stall_stack))
+                    stall_from, stall_stack = tick, stack
+            elif stall_from is not None:
+                stalls.append((tick - stall_from - PROFILE_SAMPLE_INTERVAL, stall_stack))
+                stall_from = None
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+        if stall_from is not None:
+            stalls.append((time.monotonic() - stall_from, stall_stack))
+        return stacks, stalls
+
+loop_profiler = LoopProfiler(Config.STALL_THRESHOLD_MS / 1000)
+
+@app.on_message(filters.private & filters.command("profile"))
+async def profile_command(client, message):
+    """Admin only: sample the event loop for N seconds and send the report"""
+    if message.from_user.id not in Config.ADMINS:
+        return
+    try:
+        seconds = min(max(float(message.command[1]), 1), PROFILE_MAX_SECONDS) if len(message.command) > 1 else 10
+    except ValueError:
+        await message.reply_text("**Usage:** `/profile [seconds]`")
+        return
+
+    status = await message.reply_text(f"🔬 Profiling the event loop for {seconds:g}s...")
+    try:
+        stacks, stalls = await loop_profiler.run(seconds)
+    except RuntimeError as e:
+        await status.edit(f"**❌ {e}**")
+        return
+
+    stalls.sort(key=lambda stall: stall[0], reverse=True)
+    report = io.BytesIO("".join(
+        f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1])
+    ).encode())
+    report.name = f"profile-{int(time.time())}.folded"
+
+    text = (
+        f"**🔬 Profile Finished**\n\n"
+        f"**Samples:** `{sum(stacks.values())}` over `{seconds:g}s`\n"
+        f"**Stalls over {Config.STALL_THRESHOLD_MS}ms:** `{len(stalls)}`"
+    )
+    for blocked, stack in stalls[:10]:
+        text += f"\n• `{blocked * 1000:.0f}ms` in `{stack.rsplit(';', 1)[-1]}`"
+    await status.delete()
+    await message.reply_document(report, caption=text[:1024])
 
 # ========== FILENAME INPUT HANDLER ==========
-@app.on_message(filters.private & filters.text & ~filters.command(["start", "cancel", "view_thumb", "del_thumb"]))
+@app.on_message(filters.private & filters.text & ~filters.command(["start", "cancel", "view_thumb", "del_thumb", "status", "profile"]))
 async def handle_filename(client, message):
     user_id = message.from_user.id
     
-    if user_id not in user_states:
-        return
-    
-    user_data = user_states[user_id]
+    session = await sessions.get(user_id)
     
-    if user_data['step'] != 'awaiting_filename':
+    if not session or session.step != 'awaiting_filename':
         return
     
     new_name = message.text.strip()
@@ -453,6 +4169,10 @@ async def handle_filename(client, message):
         await message.reply_text("**❌ Filename cannot be empty!**")
         return
     
+    if session.batch:
+        await handle_batch_template(client, message, session, new_name)
+        return
+    
     # Clean filename
     clean_name = re.sub(r'[<>:"/\\|?*]', '', new_name)
     
@@ -460,8 +4180,9 @@ async def handle_filename(client, message):
         await message.reply_text("**❌ Invalid filename!**")
         return
     
-    user_states[user_id]['new_filename'] = clean_name
-    user_states[user_id]['step'] = 'awaiting_upload_type'
+    session.new_filename = clean_name
+    session.step = 'awaiting_upload_type'
+    await sessions.save(session)
     
     # Delete the user's filename message and the ask message
     try:
@@ -470,38 +4191,19 @@ async def handle_filename(client, message):
         pass
     
     try:
-        if 'ask_message_id' in user_data:
-            await client.delete_messages(message.chat.id, user_data['ask_message_id'])
+        if session.ask_message_id:
+            await client.delete_messages(message.chat.id, session.ask_message_id)
     except:
         pass
     
     # Show upload type selection
-    original_name = user_data['file_info']['file_name']
-    if not original_name or original_name == 'Unknown':
-        file_type = user_data['file_info']['file_type']
-        if file_type == 'video':
-            original_ext = '.mp4'
-        elif file_type == 'audio':
-            original_ext = '.mp3'
-        else:
-            original_ext = '.bin'
-    else:
-        _, original_ext = os.path.splitext(original_name)
-        if not original_ext:
-            file_type = user_data['file_info']['file_type']
-            if file_type == 'video':
-                original_ext = '.mp4'
-            elif file_type == 'audio':
-                original_ext = '.mp3'
-            else:
-                original_ext = '.bin'
+    original_ext = original_extension(session.file_name, session.file_type)
     
     final_name = f"{clean_name}{original_ext}"
     
     # Auto-select document for specific file types
-    if original_ext.lower() in ['.pdf', '.html', '.htm', '.txt', '.doc', '.docx']:
+    if original_ext.lower() in FORCE_DOCUMENT_EXTENSIONS:
         # Auto-upload as document without asking
-        user_states[user_id]['step'] = 'processing'
         await handle_auto_upload(client, message, user_id, final_name, "document")
         return
     
@@ -518,91 +4220,358 @@ async def handle_filename(client, message):
 
 async def handle_auto_upload(client, message, user_id, final_name, upload_type):
     """Handle automatic upload for document files"""
-    user_data = user_states[user_id]
+    await submit_rename_job(client, message, user_id, final_name, upload_type)
+
+async def handle_batch_template(client, message, session, template):
+    """Check a batch name template and ask for the upload type"""
+    files = session.files()
+    try:
+        template = batch_template(template, len(files))
+        names = [batch_filename(template, n, item) for n, item in enumerate(files, 1)]
+    except (KeyError, IndexError, ValueError) as e:
+        await message.reply_text(f"**❌ Invalid template:** `{e}`")
+        return
+    
+    session.new_filename = template
+    session.step = 'awaiting_upload_type'
+    await sessions.save(session)
     
     try:
-        file_info = user_data['file_info']
-        original_message = file_info['original_message']
-        original_duration = file_info['duration']
-        
-        # Download path
-        download_path = f"downloads/{final_name}"
-        os.makedirs("downloads", exist_ok=True)
-        
-        # Create progress message
-        progress_msg = await message.reply_text("🔄 Processing your file...")
+        await message.delete()
+    except:
+        pass
+    
+    try:
+        if session.ask_message_id:
+            await client.delete_messages(message.chat.id, session.ask_message_id)
+    except:
+        pass
+    
+    # A batch of documents only needs no question
+    if all(name.lower().endswith(FORCE_DOCUMENT_EXTENSIONS) for name in names):
+        await submit_batch_job(client, message, session.user_id, "document")
+        return
+    
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📄 Document", callback_data="upload_document")],
+        [InlineKeyboardButton("🎥 Video", callback_data="upload_video")]
+    ])
+    
+    await message.reply_text(
+        f"**Select Upload Type:**\n\n**Files:** `{len(names)}`\n**First:** `{names[0]}`\n**Last:** `{names[-1]}`",
+        reply_markup=keyboard
+    )
+
+# ========== ADMIN HTTP SERVER ==========
+HTTP_REASONS = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}
+
+def render_metrics():
+    """All bot counters and gauges in the Prometheus text format"""
+    lines = []
+
+    def add(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    add("rebot_startup_seconds", "gauge", "Seconds from process start to each startup phase",
+        [({"phase": phase}, round(startup_stats[phase], 3)) for phase in ("imported", "ready") if startup_stats[phase] is not None])
+    if startup_stats["first_job"] is not None:
+        add("rebot_first_job_seconds", "gauge", "Duration of the first job after startup",
+            [({}, round(startup_stats["first_job"], 3))])
+    stats = scheduler.stats()
+    add("rebot_client_connected", "gauge", "Whether the Telegram client is connected",
+        [({}, int(bool(app.is_connected)))])
+    add("rebot_jobs_running", "gauge", "Jobs holding a transfer slot",
+        [({"lane": name}, lane["running"]) for name, lane in stats["lanes"].items()])
+    add("rebot_jobs_queued", "gauge", "Jobs waiting for a transfer slot",
+        [({"lane": name}, lane["queued"]) for name, lane in stats["lanes"].items()])
+    add("rebot_jobs_total", "counter", "Jobs by outcome",
+        [({"outcome": outcome}, count) for outcome, count in scheduler.counters.items()])
+    add("rebot_cancelled_jobs_total", "counter", "Jobs cancelled by their users",
+        [({}, cancel_stats["jobs"])])
+    add("rebot_cancel_bytes_saved_total", "counter", "Transfer bytes skipped because their job was cancelled",
+        [({}, cancel_stats["bytes_saved"])])
+    add("rebot_shared_queue_total", "counter", "Shared job queue events in this process",
+        [({"event": event}, count) for event, count in job_queue.counters.items()])
+    add("rebot_transfer_bytes_total", "counter", "Bytes moved to and from Telegram",
+        [({"direction": "download"}, download_stats["bytes"]), ({"direction": "upload"}, upload_stats["bytes"])])
+    connections = sorted(download_stats["connections"].items())
+    add("rebot_download_connection_bytes_total", "counter", "Bytes fetched over each pooled download connection",
+        [({"dc": dc_id, "connection": n}, total["bytes"]) for (dc_id, n), total in connections])
+    add("rebot_download_connection_seconds_total", "counter", "Seconds each pooled download connection spent fetching",
+        [({"dc": dc_id, "connection": n}, round(total["seconds"], 3)) for (dc_id, n), total in connections])
+    add("rebot_upload_part_retries_total", "counter", "Upload parts sent again after an error",
+        [({}, upload_stats["retries"])])
+    add("rebot_floodwaits_total", "counter", "FloodWait errors received",
+        [({"source": "outbound"}, outbound.counters["flood_waits"]), ({"source": "progress"}, progress_stats["flood_waits"])])
+    add("rebot_progress_edits_total", "counter", "Progress updates by whether they became an edit",
+        [({"result": "sent"}, progress_stats["edits_sent"]),
+         ({"result": "suppressed"}, progress_stats["samples"] - progress_stats["edits_sent"])])
+    add("rebot_cache_lookups_total", "counter", "Cache lookups by cache and result", [
+        ({"cache": "result", "result": "hit"}, result_cache.counters["hits"]),
+        ({"cache": "result", "result": "miss"}, result_cache.counters["misses"]),
+        ({"cache": "thumbnail", "result": "hit"}, thumb_cache.counters["hits"]),
+        ({"cache": "thumbnail", "result": "miss"}, thumb_cache.counters["misses"]),
+        ({"cache": "profile", "result": "hit"}, db.counters["hits"]),
+        ({"cache": "profile", "result": "miss"}, db.counters["misses"]),
+        ({"cache": "probe", "result": "hit"}, probe_stats["hits"]),
+        ({"cache": "probe", "result": "miss"}, probe_stats["probes"])
+    ])
+    add("rebot_outbound_queued", "gauge", "Chat API calls waiting in the outbound limiter",
+        [({"priority": priority}, depth) for priority, depth in outbound.stats()["queued"].items()])
+    add("rebot_memory_path_bytes", "gauge", "File bytes held by in-memory transfers",
+        [({}, memory_budget.in_use)])
+    add("rebot_storage_bytes", "gauge", "Temporary storage by root and kind", [
+        ({"root": name, "kind": kind}, root[kind])
+        for name, root in storage.stats().items()
+        for kind in ("reserved", "quota", "used", "free")
+    ])
+    add("rebot_sessions", "gauge", "Open rename dialogs", [({}, len(sessions))])
+    lines += stage_latency.render()
+    return "\n".join(lines) + "\n"
+
+class AdminServer:
+    """Health, readiness and metrics over HTTP, served on the bot's own event loop"""
+
+    def __init__(self, port):
+        self.port = port
+        self.server = None
+        self.ready = False
+        self.mongo_warm = False  # set once warm_mongo() succeeded
+        self.warming = asyncio.Lock()
+        self.routes = {
+            "/": self.healthz,
+            "/healthz": self.healthz,
+            "/readyz": self.readyz,
+            "/metrics": self.metrics
+        }
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "0.0.0.0", self.port)
+        print(f"🌐 Health check server running on port {self.port}")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            while await asyncio.wait_for(reader.readline(), 10) not in (b"\r\n", b"\n", b""):
+                pass
+
+            handler = self.routes.get(target.split("?", 1)[0])
+            if handler:
+                status, body, content_type = await handler()
+            else:
+                status, body, content_type = 404, "Not found\n", "text/plain"
+
+            payload = body.encode()
+            head = (
+                f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                f"Content-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(head.encode() + (b"" if method == "HEAD" else payload))
+            await writer.drain()
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"Admin request failed: {e}")
+        finally:
+            writer.close()
+
+    async def healthz(self):
+        try:
+            await asyncio.wait_for(db.ping(), 2)
+            mongo = True
+        except Exception:
+            mongo = False
+        checks = {"telegram": bool(app.is_connected), "mongo": mongo}
+        status = 200 if all(checks.values()) else 503
+        return status, json.dumps(checks) + "\n", "application/json"
+
+    async def readyz(self):
+        mongo = False
+        if self.ready:
+            try:
+                if self.mongo_warm:
+                    await asyncio.wait_for(db.ping(), 2)
+                    mongo = True
+                else:
+                    # Startup could not reach Mongo; try again so the bot gets ready once it is back
+                    async with self.warming:
+                        self.mongo_warm = self.mongo_warm or await asyncio.wait_for(warm_mongo(), 5)
+                    mongo = self.mongo_warm
+            except Exception:
+                mongo = False
+        ready = self.ready and bool(app.is_connected) and mongo
+        return (200 if ready else 503), json.dumps({"ready": ready}) + "\n", "application/json"
+
+    async def metrics(self):
+        return 200, render_metrics(), "text/plain; version=0.0.4"
+
+admin = AdminServer(Config.PORT)
+
+# ========== GRACEFUL SHUTDOWN ==========
+RESTARTING_TEXT = "**🔄 Bot is restarting!**\n\n"
+
+class Shutdown:
+    """Drain the bot on SIGTERM so a redeploy throws no transfer work away.
+
+    New files are refused and running jobs get DRAIN_TIMEOUT seconds to
+    finish. Whatever is left is stopped with its checkpoint on disk: a single
+    process resumes it on its next start, a worker hands it back to the
+    shared queue for the next free worker.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.draining = False
+
+    async def drain(self):
+        self.draining = True
+        admin.ready = False
+        started = time.monotonic()
+        waiting = scheduler.take_waiting()
+        running = list(scheduler.active.values())
+        logging.info(f"Draining {len(running)} running and {len(waiting)} queued jobs")
         
-        # Download file with progress
-        start_time = time.time()
+        await asyncio.gather(*(
+            self._notify(chat_id, f"{RESTARTING_TEXT}Transfers already running get {int(self.timeout)}s to finish, "
+                                  f"anything left continues automatically after the restart.")
+            for chat_id in {job.chat_id for job in running}
+        ))
         
-        file_path = await client.download_media(
-            original_message,
-            file_name=download_path,
-            progress=progress_for_pyrogram,
-            progress_args=("📥 **Downloading File**", progress_msg, start_time, final_name)
-        )
+        unfinished = []
+        if running:
+            await asyncio.wait([job.task for job in running], timeout=self.timeout)
+            unfinished = [job for job in running if not job.task.done()]
+            for job in unfinished:
+                job.task.cancel()
+            # Cancelled transfers flush their checkpoints and keep their files on the way out
+            if unfinished:
+                await asyncio.wait([job.task for job in unfinished], timeout=5)
         
-        if not file_path or not os.path.exists(file_path):
-            raise Exception("Download failed")
+        # A worker hands a batch back to the shared queue as a whole
+        stopped = {}
+        for job in waiting + unfinished:
+            lease = getattr(getattr(job, "batch", None), "lease", None)
+            stopped.setdefault(id(lease or job), (lease or job, job in waiting))
         
-        # Get thumbnail
-        thumbnail = await db.get_thumbnail(user_id)
-        thumb_path = None
-        if thumbnail:
+        saved = 0
+        for job, was_waiting in stopped.values():
             try:
-                thumb_path = await client.download_media(thumbnail)
-            except:
-                pass
-        
-        # Upload file with progress
-        start_time = time.time()
-        
-        await client.send_document(
-            message.chat.id,
-            document=file_path,
-            thumb=thumb_path,
-            caption=f"`{final_name}`",
-            progress=progress_for_pyrogram,
-            progress_args=("📤 **Uploading File**", progress_msg, start_time, final_name)
-        )
+                saved += await self._hand_off(job, was_waiting)
+            except Exception as e:
+                logging.warning(f"Could not save job {job.job_id} for after the restart: {e}")
         
-        # Success message
-        await message.reply_text(
-            f"**✅ File Renamed Successfully!**\n\n"
-            f"**New Name:** `{final_name}`\n"
-            f"**Type:** `Document`"
+        logging.info(
+            f"Drained in {time.monotonic() - started:.1f}s: {len(running) - len(unfinished)} jobs finished, "
+            f"{len(waiting) + len(unfinished)} stopped, {saved} saved to continue after the restart"
         )
-        
-        # Cleanup progress message
+
+    async def _hand_off(self, job, waiting):
+        """Leave a job that did not finish where the next start or another worker finds it"""
+        if isinstance(job, LeasedJob):
+            job.heartbeat.cancel()
+            if waiting and isinstance(job.job, RenameJob):
+                await storage.release(job.job_id)
+            await job_queue.release(job.job_id)
+            text = "continues on the next free worker."
+            saved = 1
+        else:
+            # Running files already have their checkpoint
+            saved = job.save_for_resume() if waiting else 1
+            text = "continues automatically after the restart."
+        await self._notify(job.chat_id, f"{RESTARTING_TEXT}Your transfer is saved and {text}", job.progress_msg)
+        return saved
+
+    async def _notify(self, chat_id, text, message=None):
         try:
-            await progress_msg.delete()
-        except:
-            pass
-            
+            if message:
+                await message.edit(text)
+            else:
+                await app.send_message(chat_id, text)
+        except Exception as e:
+            logging.warning(f"Could not tell chat {chat_id} about the restart: {e}")
+
+shutdown = Shutdown(Config.DRAIN_TIMEOUT)
+
+# ========== STARTUP ==========
+startup_stats = {"imported": None, "ready": None, "first_job": None}  # seconds
+
+async def warm_mongo():
+    """Open pooled connections and load what the first messages need, returns whether that worked"""
+    try:
+        # Pings in flight together each take their own connection
+        await asyncio.gather(*(db.ping() for _ in range(Config.WARM_MONGO_CONNECTIONS)))
+        await asyncio.gather(
+            sessions.warm(),
+            result_cache.warm(),
+            *([job_queue.warm()] if Config.BOT_ROLE != "all" else [])
+        )
     except Exception as e:
-        error_msg = f"**❌ Error:** `{str(e)}`"
-        await message.reply_text(error_msg)
-        logging.error(f"Upload error: {e}")
-    
-    finally:
-        # Cleanup files
-        if 'file_path' in locals() and file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass
-        if 'thumb_path' in locals() and thumb_path and os.path.exists(thumb_path):
-            try:
-                os.remove(thumb_path)
-            except:
-                pass
-        
-        # Clear user state
-        if user_id in user_states:
-            del user_states[user_id]
+        logging.warning(f"Mongo warm-up failed: {e}")
+        return False
+    return True
+
+async def warm_media_sessions():
+    """Open the media sessions transfers use before the first job asks for them"""
+    if Config.BOT_ROLE == "frontend":
+        return
+    home = await app.storage.dc_id()
+    results = await asyncio.gather(
+        media_sessions.home(app, max(Config.DOWNLOAD_CONNECTIONS, Config.UPLOAD_CONNECTIONS)),
+        *(media_sessions.get(app, dc_id, Config.DOWNLOAD_CONNECTIONS) for dc_id in sorted(Config.WARM_DCS - {home})),
+        return_exceptions=True
+    )
+    for e in results:
+        if isinstance(e, BaseException):
+            logging.warning(f"Media session warm-up failed: {e}")
+
+startup_stats["imported"] = time.monotonic() - BOOT_TIME
 
 # ========== START BOT ==========
+async def main():
+    # Job, sweep, resume and drain summaries are logged at INFO; Pyrogram's own chatter stays out
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("pyrogram").setLevel(logging.WARNING)
+    await admin.start()
+    # Mongo warms up while Telegram connects; media sessions need the connected client
+    mongo = asyncio.create_task(warm_mongo())
+    connecting = time.monotonic()
+    await app.start()
+    admin.mongo_warm, _ = await asyncio.gather(mongo, warm_media_sessions())
+    connected = time.monotonic() - connecting
+    if Config.BOT_ROLE == "all":
+        await resume_unfinished_jobs(app)
+    elif Config.BOT_ROLE == "worker":
+        # Checkpoints stay so jobs this host held can carry on when they are claimed again
+        storage.sweep(keep={checkpoint.job_id for checkpoint in recent_checkpoints()})
+        asyncio.create_task(job_queue.run_worker(app))
+    storage.start()
+    admin.ready = True
+    startup_stats["ready"] = time.monotonic() - BOOT_TIME
+    print(
+        f"✅ Bot is ready in {startup_stats['ready']:.1f}s "
+        f"(imports {startup_stats['imported']:.1f}s, connections {connected:.1f}s)"
+    )
+    await idle()
+    await shutdown.drain()
+    await media_sessions.close()
+    if thumb_pool:
+        thumb_pool.shutdown()
+    await app.stop()
+    await admin.stop()
+
+
 if __name__ == "__main__":
     print("🚀 Bot is starting...")
-    print("🌐 Health check server running on port 8080")
-    app.run()
+    app.run(main())